@@ -0,0 +1,453 @@
+#!/usr/bin/env python3
+"""
+Basemap tiles for Wall TV Maps project.
+Works out every tile a map needs up front, downloads the missing ones
+concurrently with connection reuse, per-provider rate limits and retries,
+and only then assembles them into a Web Mercator mosaic. Local MBTiles and
+PMTiles archives can stand in for a tile server.
+"""
+
+import io
+import re
+import time
+import random
+import hashlib
+import logging
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import requests
+from requests.adapters import HTTPAdapter
+import xyzservices
+import xyzservices.providers as xyz
+from PIL import Image
+
+from tile_store import TILES
+from tile_archives import is_archive, open_archive, archive_signature
+from mosaic_cache import mosaic_cache_key, load_cached_mosaic, store_cached_mosaic
+
+logger = logging.getLogger(__name__)
+
+# Half the width of the Web Mercator world, in metres
+WEB_MERCATOR_ORIGIN = 20037508.342789244
+
+# Download defaults, overridable per map under 'basemap'
+DEFAULT_WORKERS = 8
+DEFAULT_RETRIES = 4
+DEFAULT_TIMEOUT = 30
+
+# Requests per second allowed by provider (matched by name prefix); community
+# run servers get a gentle default, commercial ones with API keys a higher one
+PROVIDER_RATE_LIMITS = {
+    'OpenStreetMap': 5,
+    'OpenTopoMap': 5,
+    'Stadia': 20,
+    'Thunderforest': 20,
+    'Esri': 20,
+}
+DEFAULT_RATE_LIMIT = 10
+
+# Responses worth retrying; anything else besides 200/404 is an error
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+# First retry delay in seconds, doubled on every further attempt
+RETRY_BACKOFF = 0.5
+
+USER_AGENT = "wall-tv-maps/1.0 (basemap prefetch)"
+
+# Edge of a tile in pixels, for matching tile resolution to the output's
+TILE_SIZE = 256
+
+# Zoom settings that are worked out per map rather than given as a number
+ZOOM_MODES = ('auto', 'fit')
+
+# Tiles a map may use unless its basemap sets max_tiles; beyond it the zoom steps down
+DEFAULT_MAX_TILES = 1000
+
+# Size assumed per tile until some tiles of the provider are stored
+DEFAULT_TILE_BYTES = 30 * 1024
+
+# A dry run stops listing zooms after the first that needs more tiles than this
+MAX_PLAN_TILES = 100000
+
+# What a basemap source resolves to
+BasemapSource = namedtuple('BasemapSource', ['name', 'key', 'min_zoom', 'max_zoom', 'archive', 'provider'])
+
+def resolve_provider(source):
+    """Get the tile provider for a provider object, xyzservices name or URL template."""
+    if isinstance(source, xyzservices.TileProvider):
+        return source
+
+    if isinstance(source, dict):
+        return xyzservices.TileProvider(source)
+
+    if '{x}' in source and '{y}' in source and '{z}' in source:
+        return xyzservices.TileProvider(name=source, url=source, attribution='')
+
+    return xyz.query_name(source)
+
+def provider_slug(provider):
+    """Get a file-system safe name identifying a provider's tiles."""
+    name = re.sub(r'[^A-Za-z0-9_.-]+', '_', provider.name)[:60]
+    digest = hashlib.sha1(provider.build_url(x='{x}', y='{y}', z='{z}').encode('utf-8')).hexdigest()[:8]
+    return f"{name}-{digest}"
+
+def auto_zoom(extent):
+    """Pick a zoom level for an extent the way contextily does for zoom='auto'."""
+    x_min, y_min, x_max, y_max = extent
+    lon_length = np.degrees((x_max - x_min) / WEB_MERCATOR_ORIGIN * np.pi)
+    lat = np.degrees(np.arctan(np.sinh(np.array([y_min, y_max]) / WEB_MERCATOR_ORIGIN * np.pi)))
+    lat_length = lat[1] - lat[0]
+
+    return int(min(np.ceil(np.log2(720 / lon_length)), np.ceil(np.log2(720 / lat_length))))
+
+def fit_zoom(metres_per_pixel):
+    """Pick the zoom whose tile pixels come closest in size to the output pixels."""
+    return int(round(np.log2(2 * WEB_MERCATOR_ORIGIN / (TILE_SIZE * metres_per_pixel))))
+
+def validate_zoom(zoom, name, min_zoom, max_zoom, auto):
+    """Check a zoom level against a source's range, clipping inferred ones."""
+    if min_zoom <= zoom <= max_zoom:
+        return zoom
+
+    if auto:
+        return min(max(zoom, min_zoom), max_zoom)
+
+    raise ValueError(f"Zoom {zoom} is not valid for {name} (valid zooms: {min_zoom} - {max_zoom})")
+
+def tile_range(extent, zoom):
+    """Get the (x, y) tile index ranges covering a Web Mercator extent."""
+    x_min, y_min, x_max, y_max = extent
+    tile_size = 2 * WEB_MERCATOR_ORIGIN / 2 ** zoom
+    last = 2 ** zoom - 1
+
+    def index(value):
+        return int(min(max(np.floor(value / tile_size), 0), last))
+
+    xs = range(index(x_min + WEB_MERCATOR_ORIGIN), index(x_max + WEB_MERCATOR_ORIGIN) + 1)
+    ys = range(index(WEB_MERCATOR_ORIGIN - y_max), index(WEB_MERCATOR_ORIGIN - y_min) + 1)
+    return xs, ys
+
+def tile_count(extent, zoom):
+    """Count the tiles covering an extent at a zoom level."""
+    xs, ys = tile_range(extent, zoom)
+    return len(xs) * len(ys)
+
+def tile_extent(xs, ys, zoom):
+    """Get the Web Mercator extent (left, right, bottom, top) of a block of tiles."""
+    tile_size = 2 * WEB_MERCATOR_ORIGIN / 2 ** zoom
+    return (
+        xs.start * tile_size - WEB_MERCATOR_ORIGIN,
+        xs.stop * tile_size - WEB_MERCATOR_ORIGIN,
+        WEB_MERCATOR_ORIGIN - ys.stop * tile_size,
+        WEB_MERCATOR_ORIGIN - ys.start * tile_size,
+    )
+
+class RateLimiter:
+    """Spaces out requests to at most a given number per second, across threads."""
+
+    def __init__(self, rate):
+        """Initialize with the allowed requests per second (None for unlimited)."""
+        self.interval = 1 / rate if rate else 0
+        self.next_slot = 0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        """Block until the next request may be sent."""
+        if not self.interval:
+            return
+
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot)
+            self.next_slot = slot + self.interval
+
+        if slot > now:
+            time.sleep(slot - now)
+
+# Shared by every map in the process, so limits hold across maps too
+RATE_LIMITERS = {}
+RATE_LIMITERS_LOCK = threading.Lock()
+
+def rate_limiter(provider, rate=None):
+    """Get the rate limiter of a provider."""
+    if rate is None:
+        rate = next(
+            (limit for prefix, limit in PROVIDER_RATE_LIMITS.items() if provider.name.startswith(prefix)),
+            DEFAULT_RATE_LIMIT
+        )
+
+    with RATE_LIMITERS_LOCK:
+        limiter = RATE_LIMITERS.get(provider.name)
+        if limiter is None or limiter.interval != (1 / rate if rate else 0):
+            limiter = RATE_LIMITERS[provider.name] = RateLimiter(rate)
+        return limiter
+
+class TileFetcher:
+    """Downloads tiles over pooled keep-alive connections, one session per thread."""
+
+    def __init__(self, workers=DEFAULT_WORKERS, retries=DEFAULT_RETRIES, timeout=DEFAULT_TIMEOUT):
+        """Initialize with the number of parallel downloads and retry policy."""
+        self.workers = workers
+        self.retries = retries
+        self.timeout = timeout
+        self.local = threading.local()
+
+    def session(self):
+        """Get this thread's HTTP session."""
+        session = getattr(self.local, 'session', None)
+        if session is None:
+            session = requests.Session()
+            session.headers['User-Agent'] = USER_AGENT
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=self.workers)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            self.local.session = session
+        return session
+
+    def fetch(self, url, limiter):
+        """Download one tile, returning its bytes, or None if the server has no such tile."""
+        for attempt in range(self.retries + 1):
+            limiter.wait()
+            delay = RETRY_BACKOFF * 2 ** attempt * (1 + random.random() / 2)
+
+            try:
+                response = self.session().get(url, timeout=self.timeout)
+            except requests.RequestException as e:
+                error = e
+            else:
+                if response.status_code == 200:
+                    return response.content
+                if response.status_code == 404:
+                    return None
+                if response.status_code not in RETRY_STATUSES:
+                    response.raise_for_status()
+
+                error = requests.HTTPError(f"{response.status_code} for {url}", response=response)
+                retry_after = response.headers.get('Retry-After', '')
+                if retry_after.isdigit():
+                    delay = max(delay, int(retry_after))
+
+            if attempt < self.retries:
+                logger.debug(f"Retrying tile {url} in {delay:.1f}s: {error}")
+                time.sleep(delay)
+
+        raise error
+
+    def prefetch(self, provider, tiles, store, limiter):
+        """Download every tile of the list that is not stored yet.
+
+        Returns the number of tiles downloaded. Tiles the server does not
+        have are recorded as absent, so later renders do not ask for them
+        again; any other failure is raised once all downloads have finished.
+        """
+        slug = provider_slug(provider)
+        missing = store.missing(slug, tiles)
+        if not missing:
+            return 0
+
+        def download(tile):
+            z, x, y = tile
+            data = self.fetch(provider.build_url(x=x, y=y, z=z), limiter)
+            if data is not None:
+                store.put(slug, z, x, y, data)
+            else:
+                store.put_absent(slug, z, x, y)
+            return data is not None
+
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            futures = [pool.submit(download, tile) for tile in missing]
+            results = [future.exception() or future.result() for future in futures]
+
+        errors = [result for result in results if isinstance(result, Exception)]
+        if errors:
+            raise RuntimeError(f"{len(errors)} of {len(missing)} tiles could not be downloaded: {errors[0]}")
+
+        return sum(results)
+
+def assemble_mosaic(tiles, xs, ys, zoom, name):
+    """Paste tiles ({(z, x, y): bytes}) into one RGBA image; missing tiles stay transparent."""
+    mosaic = None
+
+    for row, y in enumerate(ys):
+        for column, x in enumerate(xs):
+            data = tiles.get((zoom, x, y))
+            if data is None:
+                continue
+
+            with Image.open(io.BytesIO(data)) as tile:
+                tile = tile.convert('RGBA')
+
+            if mosaic is None:
+                # Tile size comes from the provider's tiles (256, or 512 for retina sets)
+                tile_size = tile.width
+                mosaic = Image.new('RGBA', (len(xs) * tile_size, len(ys) * tile_size), (0, 0, 0, 0))
+
+            mosaic.paste(tile, (column * tile_size, row * tile_size))
+
+    if mosaic is None:
+        raise RuntimeError(f"No tiles available from {name} at zoom {zoom}")
+
+    return np.asarray(mosaic)
+
+def basemap_source(source):
+    """Resolve a basemap source: a tile provider or the path of a tile archive."""
+    if is_archive(source):
+        archive = open_archive(source)
+        return BasemapSource(
+            archive.name, archive_signature(source), archive.min_zoom, archive.max_zoom, archive, None
+        )
+
+    provider = resolve_provider(source)
+    return BasemapSource(
+        provider.name, provider_slug(provider), provider.get('min_zoom', 0), provider.get('max_zoom', 30),
+        None, provider
+    )
+
+def tile_bytes(basemap, store=None):
+    """Estimate the download size of one tile of a source, from the tiles already stored."""
+    if basemap.provider is None:
+        return DEFAULT_TILE_BYTES
+    return (store or TILES).average_size(basemap.key) or DEFAULT_TILE_BYTES
+
+def requested_zoom(basemap, extent, zoom='auto', metres_per_pixel=None):
+    """Get the zoom level a zoom setting asks for, within the source's range.
+
+    zoom is a number, 'auto' (contextily's choice from the extent alone)
+    or 'fit' (tile pixels matching output pixels, which needs
+    metres_per_pixel).
+    """
+    if zoom == 'fit':
+        if metres_per_pixel is None:
+            raise ValueError("zoom 'fit' needs the output resolution")
+        level = fit_zoom(metres_per_pixel)
+    elif zoom == 'auto':
+        level = auto_zoom(extent)
+    else:
+        level = int(zoom)
+
+    return validate_zoom(level, basemap.name, basemap.min_zoom, basemap.max_zoom, zoom in ZOOM_MODES)
+
+def over_budget(tiles, size, max_tiles, max_bytes):
+    """Check whether a tile count and estimated size exceed a budget (None for no limit)."""
+    return (max_tiles is not None and tiles > max_tiles) or (max_bytes is not None and size > max_bytes)
+
+def choose_zoom(source, extent, zoom='auto', metres_per_pixel=None, max_tiles=DEFAULT_MAX_TILES,
+                max_bytes=None, store=None):
+    """Resolve a zoom setting to the zoom level to render, within the tile budget.
+
+    When the requested zoom needs more than max_tiles tiles, or more than
+    max_bytes of estimated downloads, the zoom steps down until it fits
+    and a warning says so.
+    """
+    basemap = source if isinstance(source, BasemapSource) else basemap_source(source)
+    level = requested_zoom(basemap, extent, zoom, metres_per_pixel)
+    per_tile = tile_bytes(basemap, store)
+
+    chosen = level
+    while chosen > basemap.min_zoom and over_budget(
+            tile_count(extent, chosen), tile_count(extent, chosen) * per_tile, max_tiles, max_bytes):
+        chosen -= 1
+
+    if chosen != level:
+        tiles = tile_count(extent, level)
+        logger.warning(
+            f"Basemap {basemap.name} zoom {level} needs {tiles} tiles (~{tiles * per_tile / (1024 * 1024):.0f} MB), "
+            f"over the budget of {max_tiles} tiles" + (f" / {max_bytes / (1024 * 1024):.0f} MB" if max_bytes else "") +
+            f"; using zoom {chosen} ({tile_count(extent, chosen)} tiles) instead"
+        )
+
+    return chosen
+
+def plan_basemap(source, extent, zoom='auto', metres_per_pixel=None, max_tiles=DEFAULT_MAX_TILES,
+                 max_bytes=None, store=None):
+    """Work out what each zoom level of a basemap would take, without downloading anything.
+
+    Returns (zoom to render, rows) where each row is a dict with the
+    zoom, its tile count, estimated size in bytes, source pixels per
+    output pixel (if metres_per_pixel is given) and flags marking the
+    requested zoom and whether it is over budget. The row of the zoom to
+    render also has the number of its tiles already stored, for tile servers.
+    """
+    basemap = basemap_source(source)
+    level = requested_zoom(basemap, extent, zoom, metres_per_pixel)
+    chosen = choose_zoom(basemap, extent, level, metres_per_pixel, max_tiles, max_bytes, store)
+    per_tile = tile_bytes(basemap, store)
+
+    rows = []
+    for z in range(basemap.min_zoom, basemap.max_zoom + 1):
+        if rows and rows[-1]['tiles'] > MAX_PLAN_TILES and z > level:
+            break
+
+        tiles = tile_count(extent, z)
+        rows.append({
+            'zoom': z,
+            'tiles': tiles,
+            'bytes': tiles * per_tile,
+            'scale': metres_per_pixel / (2 * WEB_MERCATOR_ORIGIN / (TILE_SIZE * 2 ** z)) if metres_per_pixel else None,
+            'requested': z == level,
+            'over_budget': over_budget(tiles, tiles * per_tile, max_tiles, max_bytes),
+        })
+
+        if z == chosen and basemap.provider is not None:
+            xs, ys = tile_range(extent, z)
+            wanted = [(z, x, y) for y in ys for x in xs]
+            rows[-1]['cached'] = len(wanted) - len((store or TILES).missing(basemap.key, wanted))
+
+    return chosen, rows
+
+def fetch_basemap(source, extent, zoom='auto', metres_per_pixel=None, max_tiles=DEFAULT_MAX_TILES,
+                  max_bytes=None, workers=DEFAULT_WORKERS, rate_limit=None, retries=DEFAULT_RETRIES,
+                  store=None, use_cache=True):
+    """Download and assemble the basemap for a Web Mercator extent.
+
+    extent is (x_min, y_min, x_max, y_max). source may also be the path of
+    an MBTiles or PMTiles archive, which is read without any network access.
+    The zoom is resolved by choose_zoom. Returns the mosaic as an RGBA
+    array and its extent as (left, right, bottom, top), ready for imshow.
+
+    Assembled mosaics are cached by source, zoom and tile block, so maps
+    over the same area (at any size or alpha) decode the tiles only once.
+    """
+    basemap = basemap_source(source)
+    name, source_key, archive, provider = basemap.name, basemap.key, basemap.archive, basemap.provider
+    zoom = choose_zoom(basemap, extent, zoom, metres_per_pixel, max_tiles, max_bytes, store)
+
+    xs, ys = tile_range(extent, zoom)
+
+    cache_key = None
+    if use_cache:
+        cache_key = mosaic_cache_key(source=source_key, zoom=zoom, xs=[xs.start, xs.stop], ys=[ys.start, ys.stop])
+        cached = load_cached_mosaic(cache_key)
+        if cached is not None:
+            logger.info(f"Basemap {name} zoom {zoom}: using cached mosaic of {len(xs) * len(ys)} tiles")
+            return cached
+
+    start = time.perf_counter()
+
+    if archive is not None:
+        tiles = archive.read_tiles(zoom, xs, ys)
+        logger.info(
+            f"Basemap {name} zoom {zoom}: {len(tiles)} of {len(xs) * len(ys)} tiles "
+            f"read from {source} in {time.perf_counter() - start:.2f}s"
+        )
+    else:
+        store = store or TILES
+        wanted = [(zoom, x, y) for y in ys for x in xs]
+
+        fetcher = TileFetcher(workers=workers, retries=retries)
+        downloaded = fetcher.prefetch(provider, wanted, store, rate_limiter(provider, rate_limit))
+        logger.info(
+            f"Basemap {name} zoom {zoom}: {len(wanted)} tiles, "
+            f"{downloaded} downloaded in {time.perf_counter() - start:.1f}s"
+        )
+        tiles = store.get_many(source_key, wanted)
+
+    mosaic = assemble_mosaic(tiles, xs, ys, zoom, name)
+    mosaic_extent = tile_extent(xs, ys, zoom)
+
+    if cache_key is not None:
+        store_cached_mosaic(cache_key, mosaic, mosaic_extent)
+
+    return mosaic, mosaic_extent
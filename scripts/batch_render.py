@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+"""
+Batch rendering for Wall TV Maps project.
+Renders many map configs in one run over a pool of worker processes,
+which start with the rendering stack already imported and each render
+maps until the batch is done, and reports the outcome of every map.
+"""
+
+import os
+import time
+import queue
+import logging
+import multiprocessing
+from pathlib import Path
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+import yaml
+
+logger = logging.getLogger(__name__)
+
+# Outcome of one config: status is 'rendered', 'degraded' (rendered without
+# some layers or the basemap), 'up to date' or 'failed'
+MapResult = namedtuple('MapResult', ['config', 'status', 'elapsed', 'error'])
+
+# Configs named like this check the set-up rather than make a map for the wall
+TEST_CONFIG_PREFIX = 'test_'
+
+def map_configs(paths, skip_tests=False):
+    """Get the map configs among YAML files.
+
+    Files that are not maps, such as collections of snippets to copy into
+    configs, are left out, as are test configs with skip_tests. Files that
+    cannot be read are kept, so the batch reports them as failed.
+    """
+    configs = []
+    for path in map(Path, paths):
+        if skip_tests and path.name.startswith(TEST_CONFIG_PREFIX):
+            logger.info(f"Skipping {path}: test config")
+            continue
+
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                config = yaml.safe_load(f)
+        except (OSError, yaml.YAMLError):
+            configs.append(path)
+            continue
+
+        if isinstance(config, dict) and 'name' in config and 'layers' in config:
+            configs.append(path)
+        else:
+            logger.info(f"Skipping {path}: not a map config")
+
+    return configs
+
+def describe_error(error):
+    """Describe an error on one line, for the per-map report."""
+    return f"{type(error).__name__}: {' '.join(str(error).split())}"
+
+def render_map(generator_factory, config_file, settings):
+    """Render one config and return its MapResult and the future of its encode.
+
+    settings are set as attributes of the generator (e.g. force). Errors
+    are returned instead of raised, so a broken map never stops the batch.
+    The map is encoded in the background while the next one renders; the
+    future is None if nothing is being encoded.
+    """
+    start = time.perf_counter()
+
+    try:
+        generator = generator_factory(config_file)
+        for name, value in settings.items():
+            setattr(generator, name, value)
+
+        rendered = generator.generate()
+
+        if rendered and generator.failures:
+            result = MapResult(str(config_file), 'degraded', time.perf_counter() - start, '; '.join(generator.failures))
+        else:
+            result = MapResult(str(config_file), 'rendered' if rendered else 'up to date', time.perf_counter() - start, None)
+        return result, generator.encoding
+
+    except Exception as e:
+        return MapResult(str(config_file), 'failed', time.perf_counter() - start, describe_error(e)), None
+
+def encode_failures(encodes):
+    """Wait for the encodes of rendered maps, given as (index, MapResult, future).
+
+    Yields (index, MapResult) for every map whose encode failed, with the
+    map now marked as failed.
+    """
+    for index, result, encode in encodes:
+        error = encode.exception()
+        if error is not None:
+            yield index, result._replace(status='failed', error=f"could not be saved: {describe_error(error)}")
+
+def render_worker(generator_factory, settings, tasks, finished):
+    """Render (index, config) tasks from a queue until it is empty.
+
+    Puts (index, MapResult) on the finished queue as each map renders.
+    Encodes are only waited for once the queue is empty, and a map whose
+    encode failed is then put on the finished queue again as failed.
+    """
+    encodes = []
+
+    while True:
+        try:
+            index, config_file = tasks.get_nowait()
+        except queue.Empty:
+            break
+
+        result, encode = render_map(generator_factory, config_file, settings)
+        finished.put((index, result))
+        if encode is not None:
+            encodes.append((index, result, encode))
+
+    for index, result in encode_failures(encodes):
+        finished.put((index, result))
+
+def report(result):
+    """Log the outcome of one map."""
+    if result.error is None:
+        logger.info(f"{result.config}: {result.status} in {result.elapsed:.1f}s")
+    elif result.status == 'degraded':
+        logger.warning(f"{result.config}: degraded in {result.elapsed:.1f}s: {result.error}")
+    else:
+        logger.error(f"{result.config}: failed after {result.elapsed:.1f}s: {result.error}")
+
+def render_batch(generator_factory, configs, jobs=None, settings=None):
+    """Render configs over a pool of worker processes.
+
+    jobs defaults to the number of CPUs; with one job, maps render in this
+    process. Workers are forked where the platform allows it, so they share
+    the imports already loaded here. Returns the MapResult of every config,
+    in the order given.
+    """
+    settings = settings or {}
+    jobs = max(1, min(jobs or os.cpu_count() or 1, len(configs)))
+    start = time.perf_counter()
+    logger.info(f"Rendering {len(configs)} maps with {jobs} worker{'s' if jobs > 1 else ''}")
+
+    results = [None] * len(configs)
+    if jobs == 1:
+        encodes = []
+        for index, config_file in enumerate(configs):
+            results[index], encode = render_map(generator_factory, config_file, settings)
+            report(results[index])
+            if encode is not None:
+                encodes.append((index, results[index], encode))
+
+        for index, result in encode_failures(encodes):
+            results[index] = result
+            report(result)
+    else:
+        context = multiprocessing.get_context('fork') if 'fork' in multiprocessing.get_all_start_methods() else multiprocessing.get_context()
+        with context.Manager() as manager, ProcessPoolExecutor(max_workers=jobs, mp_context=context) as pool:
+            # Workers take maps from a shared queue, so each keeps rendering
+            # (and encoding in the background) until the batch is done
+            tasks, finished = manager.Queue(), manager.Queue()
+            for task in enumerate(configs):
+                tasks.put(task)
+
+            workers = [pool.submit(render_worker, generator_factory, settings, tasks, finished) for _ in range(jobs)]
+
+            while not (all(worker.done() for worker in workers) and finished.empty()):
+                try:
+                    index, result = finished.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+                results[index] = result
+                report(result)
+
+            for worker in workers:
+                if worker.exception() is None:
+                    continue
+
+                # A worker itself died, e.g. killed for running out of memory,
+                # which stops the pool; every map without an outcome failed
+                for index, config_file in enumerate(configs):
+                    if results[index] is None:
+                        results[index] = MapResult(
+                            str(config_file), 'failed', time.perf_counter() - start, describe_error(worker.exception())
+                        )
+                        report(results[index])
+
+    counts = {status: sum(result.status == status for result in results) for status in ('rendered', 'degraded', 'up to date', 'failed')}
+    summary = ", ".join(f"{count} {status}" for status, count in counts.items() if count)
+    logger.info(f"Batch finished in {time.perf_counter() - start:.1f}s: {summary}")
+
+    for result in results:
+        if result.status == 'degraded':
+            logger.warning(f"Degraded: {result.config} ({result.error})")
+        elif result.error is not None:
+            logger.error(f"Failed: {result.config} ({result.error})")
+
+    return results
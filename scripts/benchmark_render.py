@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+"""
+Benchmark layer rendering for Wall TV Maps project.
+Times drawing the coastline and admin-1 layers with the collection
+renderer against GeoDataFrame.plot, on a full-size output canvas.
+"""
+
+import time
+import logging
+from pathlib import Path
+import geopandas as gpd
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+import numpy as np
+import click
+
+from collection_renderer import draw_layer
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+DATA_DIR = Path("data")
+
+# Layers to benchmark, styled like the map configs draw them. GeoDataFrame.plot
+# strokes lines with fill_color, so the coastline sets both colours to make
+# both renderers draw the same pixels
+BENCHMARK_LAYERS = {
+    'coastline': {
+        'file': "raw/ne_10m_coastline.shp",
+        'style': {'fill_color': '#1f77b4', 'stroke_color': '#1f77b4', 'stroke_width': 2},
+    },
+    'admin1': {
+        'file': "raw/ne_10m_admin_1_states_provinces.shp",
+        'style': {'fill_color': '#e6f3e6', 'stroke_color': '#333333', 'stroke_width': 1, 'opacity': 0.9},
+    },
+}
+
+OUTPUT_WIDTH = 4000
+OUTPUT_HEIGHT = 2250
+DPI = 300
+
+def new_canvas(bounds):
+    """Create a figure matching the map generator's canvas."""
+    fig, ax = plt.subplots(figsize=(OUTPUT_WIDTH / DPI, OUTPUT_HEIGHT / DPI), dpi=DPI)
+    ax.set_axis_off()
+    plt.subplots_adjust(left=0, bottom=0, right=1, top=1)
+    ax.set_xlim(bounds[0], bounds[2])
+    ax.set_ylim(bounds[1], bounds[3])
+    ax.set_aspect('equal')
+    return fig, ax
+
+def render_geopandas(ax, gdf, style):
+    """Draw a layer the way the map generator did before the collection renderer."""
+    gdf.plot(
+        ax=ax,
+        color=style.get('fill_color', 'lightblue'),
+        edgecolor=style.get('stroke_color', 'black'),
+        linewidth=style.get('stroke_width', 1),
+        alpha=style.get('opacity', 1.0),
+    )
+
+def render_collections(ax, gdf, style):
+    """Draw a layer with the collection renderer."""
+    draw_layer(ax, gdf.geometry.values, style)
+
+RENDERERS = {
+    'geopandas': render_geopandas,
+    'collections': render_collections,
+}
+
+def time_renderer(render, gdf, style, repeat):
+    """Time building the artists and rasterizing them, returning median seconds."""
+    build_times = []
+    draw_times = []
+
+    for _ in range(repeat):
+        fig, ax = new_canvas(gdf.total_bounds)
+
+        start = time.perf_counter()
+        render(ax, gdf, style)
+        built = time.perf_counter()
+        fig.canvas.draw()
+        drawn = time.perf_counter()
+        plt.close(fig)
+
+        build_times.append(built - start)
+        draw_times.append(drawn - built)
+
+    return np.median(build_times), np.median(draw_times)
+
+@click.command()
+@click.option('--repeat', '-n', default=3, help='Runs per renderer; the median is reported')
+@click.option('--layer', '-l', 'layers', multiple=True, type=click.Choice(list(BENCHMARK_LAYERS)),
+              help='Layer to benchmark (default: all)')
+def main(repeat, layers):
+    """Compare the collection renderer against GeoDataFrame.plot."""
+
+    for layer_name in layers or BENCHMARK_LAYERS:
+        layer = BENCHMARK_LAYERS[layer_name]
+        file_path = DATA_DIR / layer['file']
+
+        if not file_path.exists():
+            logger.warning(f"Skipping {layer_name}, data file not found: {file_path}")
+            continue
+
+        gdf = gpd.read_file(file_path).to_crs('EPSG:3857')
+        logger.info(f"{layer_name}: {len(gdf)} features")
+
+        results = {}
+        for renderer, render in RENDERERS.items():
+            build, draw = time_renderer(render, gdf, layer['style'], repeat)
+            results[renderer] = build + draw
+            logger.info(f"  {renderer:12s} build {build:6.2f}s  draw {draw:6.2f}s  total {build + draw:6.2f}s")
+
+        logger.info(f"  speedup: {results['geopandas'] / results['collections']:.1f}x")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+"""
+Benchmark command line start-up for Wall TV Maps project.
+Times generate_map.py commands that should not need the geodata stack
+(--help and the cache commands) against a start-up target, and lists the
+slowest imports of the command line and map generator modules.
+"""
+
+import sys
+import time
+import logging
+import statistics
+import subprocess
+from pathlib import Path
+import click
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+SCRIPTS_DIR = Path(__file__).resolve().parent
+
+# Commands that only touch the command line and the tile store
+STARTUP_COMMANDS = {
+    'help': ['--help'],
+    'cache-info': ['--cache-info'],
+}
+
+# Start-up each command must stay under, in seconds
+STARTUP_TARGET = 0.5
+
+# Modules whose imports are profiled: the command line, and what rendering adds to it
+PROFILED_MODULES = ['generate_map', 'map_generator']
+
+def time_command(args, repeat):
+    """Time a generate_map.py command from start to exit, returning median seconds."""
+    times = []
+
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run(
+            [sys.executable, str(SCRIPTS_DIR / 'generate_map.py'), *args],
+            check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+        )
+        times.append(time.perf_counter() - start)
+
+    return statistics.median(times)
+
+def import_times(module):
+    """Import a module in a fresh interpreter and time it.
+
+    Returns the module's cumulative import seconds, and those of each
+    module it imports directly (including what they import in turn).
+    """
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        cwd=SCRIPTS_DIR, check=True, capture_output=True, text=True
+    )
+
+    # Lines look like "import time: self [us] | cumulative | name", with names
+    # indented two spaces per nesting level and listed before their importer
+    entries = []
+    for line in result.stderr.splitlines():
+        fields = line.removeprefix('import time:').split('|')
+        if len(fields) == 3 and fields[1].strip().isdigit():
+            name = fields[2].rstrip()
+            depth = (len(name) - len(name.lstrip()) - 1) // 2
+            entries.append((depth, name.strip(), int(fields[1]) / 1e6))
+
+    # The module's own imports are the entries since the previous top-level one
+    total = 0
+    direct = {}
+    for depth, name, seconds in entries:
+        if depth == 0:
+            if name == module:
+                total = seconds
+                break
+            direct = {}
+        elif depth == 1:
+            direct[name] = seconds
+
+    return total, direct
+
+@click.command()
+@click.option('--repeat', '-n', default=5, help='Runs per command; the median is reported')
+@click.option('--top', default=10, help='Slowest direct imports listed per module')
+def main(repeat, top):
+    """Check that command line start-up stays under the target."""
+
+    slow = []
+    for name, args in STARTUP_COMMANDS.items():
+        elapsed = time_command(args, repeat)
+        logger.info(f"{name:12s} {elapsed:6.3f}s (target {STARTUP_TARGET:.2f}s)")
+        if elapsed > STARTUP_TARGET:
+            slow.append(name)
+
+    for module in PROFILED_MODULES:
+        total, direct = import_times(module)
+        logger.info(f"import {module}: {total:.3f}s")
+
+        for name, seconds in sorted(direct.items(), key=lambda item: -item[1])[:top]:
+            logger.info(f"  {name:32s} {seconds:6.3f}s")
+
+    if slow:
+        logger.error(f"Start-up over {STARTUP_TARGET:.2f}s: {', '.join(slow)}")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
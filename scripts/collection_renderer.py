@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+"""
+Collection-based layer rendering for Wall TV Maps project.
+Turns a whole layer's geometry arrays into one matplotlib collection per
+geometry kind in a single vectorized pass, instead of going through
+GeoDataFrame.plot and its per-geometry patch construction.
+"""
+
+import numpy as np
+import shapely
+from matplotlib.collections import LineCollection, PathCollection
+from matplotlib.path import Path
+from matplotlib import rcParams
+
+# shapely geometry type ids of the single-part geometries
+POINT_TYPES = [shapely.GeometryType.POINT]
+LINE_TYPES = [shapely.GeometryType.LINESTRING, shapely.GeometryType.LINEARRING]
+POLYGON_TYPES = [shapely.GeometryType.POLYGON]
+
+def split_parts(geometry):
+    """Explode a geometry array into (points, lines, polygons) part arrays."""
+    parts = shapely.get_parts(np.asarray(geometry))
+    parts = parts[~shapely.is_empty(parts)]
+    type_ids = shapely.get_type_id(parts)
+
+    return (
+        parts[np.isin(type_ids, POINT_TYPES)],
+        parts[np.isin(type_ids, LINE_TYPES)],
+        parts[np.isin(type_ids, POLYGON_TYPES)],
+    )
+
+def ring_offsets(index, count):
+    """Get the start offset of each group in a sorted group index array."""
+    return np.searchsorted(index, np.arange(count + 1), side='left')
+
+def polygon_paths(polygons):
+    """Build one compound path per polygon, shells and holes included.
+
+    Shells are wound counter-clockwise and holes clockwise, so holes stay
+    empty under matplotlib's non-zero fill rule whatever the source data
+    orientation was.
+    """
+    rings, ring_polygon = shapely.get_rings(polygons, return_index=True)
+    coords, coord_ring = shapely.get_coordinates(rings, return_index=True)
+
+    ring_start = ring_offsets(coord_ring, len(rings))
+    polygon_start = ring_offsets(ring_polygon, len(polygons))
+
+    # The first ring of each polygon is its shell
+    is_shell = np.zeros(len(rings), dtype=bool)
+    is_shell[polygon_start[:-1]] = True
+
+    # Reverse the coordinates of every ring wound the wrong way
+    flip = shapely.is_ccw(rings) != is_shell
+    if flip.any():
+        position = np.arange(len(coords))
+        reversed_position = ring_start[coord_ring] + ring_start[coord_ring + 1] - 1 - position
+        coords = coords[np.where(flip[coord_ring], reversed_position, position)]
+
+    codes = np.full(len(coords), Path.LINETO, dtype=Path.code_type)
+    codes[ring_start[:-1]] = Path.MOVETO
+    codes[ring_start[1:] - 1] = Path.CLOSEPOLY
+
+    vertex_start = ring_start[polygon_start]
+    return [
+        Path(coords[start:end], codes[start:end])
+        for start, end in zip(vertex_start[:-1], vertex_start[1:])
+    ]
+
+def line_segments(lines):
+    """Get the vertex array of every line."""
+    coords, coord_line = shapely.get_coordinates(lines, return_index=True)
+    return np.split(coords, ring_offsets(coord_line, len(lines))[1:-1])
+
+def draw_layer(ax, geometry, style):
+    """Draw a layer's geometry on the axis with the given layer style.
+
+    Polygons are filled with ``fill_color`` and outlined with
+    ``stroke_color``, lines are stroked with ``stroke_color`` and points are
+    drawn as markers like GeoDataFrame.plot does. Returns the collections
+    that were added.
+    """
+    fill_color = style.get('fill_color', 'lightblue')
+    stroke_color = style.get('stroke_color', 'black')
+    stroke_width = style.get('stroke_width', 1)
+    opacity = style.get('opacity', 1.0)
+    zorder = style.get('zorder', 1)
+
+    points, lines, polygons = split_parts(geometry)
+    collections = []
+
+    if len(polygons):
+        collections.append(PathCollection(
+            polygon_paths(polygons),
+            facecolors=fill_color,
+            edgecolors=stroke_color,
+            linewidths=stroke_width,
+            alpha=opacity,
+            zorder=zorder,
+        ))
+
+    if len(lines):
+        collections.append(LineCollection(
+            line_segments(lines),
+            colors=stroke_color,
+            linewidths=stroke_width,
+            alpha=opacity,
+            zorder=zorder,
+        ))
+
+    for collection in collections:
+        ax.add_collection(collection, autolim=False)
+
+    if len(points):
+        xy = shapely.get_coordinates(points)
+        collections.append(ax.scatter(
+            xy[:, 0], xy[:, 1],
+            s=rcParams['lines.markersize'] ** 2,
+            facecolors=fill_color,
+            edgecolors=stroke_color,
+            linewidths=stroke_width,
+            alpha=opacity,
+            zorder=zorder,
+        ))
+
+    return collections
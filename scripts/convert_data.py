@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+"""
+Convert geodata for Wall TV Maps project.
+Writes spatially indexed FlatGeobuf copies of the downloaded shapefiles and
+processed GeoJSON files, which map generation then reads transparently.
+"""
+
+import sys
+import time
+import logging
+from pathlib import Path
+import geopandas as gpd
+import click
+
+from utils import binary_path, get_file_size_mb
+from layer_cache import source_mtime
+
+# Setup logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+DATA_DIR = Path("data")
+RAW_DIR = DATA_DIR / "raw"
+PROCESSED_DIR = DATA_DIR / "processed"
+
+# Source formats that get a FlatGeobuf copy
+CONVERTIBLE_PATTERNS = {
+    RAW_DIR: ['*.shp', '*.gpkg', '*.geojson'],
+    PROCESSED_DIR: ['*.geojson', '*.gpkg'],
+}
+
+def find_convertible_files():
+    """Find all raw and processed files that can be converted."""
+    files = []
+
+    for directory, patterns in CONVERTIBLE_PATTERNS.items():
+        if not directory.exists():
+            logger.warning(f"Directory not found: {directory}")
+            continue
+
+        for pattern in patterns:
+            files.extend(sorted(directory.rglob(pattern)))
+
+    return files
+
+def is_up_to_date(source_path):
+    """Check whether the FlatGeobuf copy is newer than its source, including a shapefile's sidecars."""
+    target_path = binary_path(source_path)
+    if not target_path.exists():
+        return False
+
+    return target_path.stat().st_mtime >= source_mtime(source_path)
+
+def convert_file(source_path):
+    """Convert a single file to FlatGeobuf with a spatial index."""
+    target_path = binary_path(source_path)
+    start = time.perf_counter()
+
+    gdf = gpd.read_file(source_path, engine='pyogrio')
+    gdf.to_file(target_path, driver='FlatGeobuf', engine='pyogrio')
+
+    elapsed = time.perf_counter() - start
+    logger.info(
+        f"Converted {source_path} ({get_file_size_mb(source_path):.1f} MB) -> "
+        f"{target_path.name} ({get_file_size_mb(target_path):.1f} MB) in {elapsed:.1f}s"
+    )
+
+@click.command()
+@click.option('--force', is_flag=True, help='Convert files even if the FlatGeobuf copy is up to date')
+@click.argument('files', nargs=-1, type=click.Path(exists=True, path_type=Path))
+def main(force, files):
+    """Convert raw and processed geodata to FlatGeobuf."""
+
+    files = list(files) or find_convertible_files()
+    logger.info(f"Found {len(files)} files to check")
+
+    failed = 0
+
+    for source_path in files:
+        if not force and is_up_to_date(source_path):
+            logger.debug(f"Up to date: {source_path}")
+            continue
+
+        try:
+            convert_file(source_path)
+        except Exception as e:
+            logger.error(f"Failed to convert {source_path}: {e}")
+            failed += 1
+
+    if failed:
+        logger.error(f"{failed} files could not be converted")
+        sys.exit(1)
+
+    logger.info("Data conversion complete!")
+
+if __name__ == "__main__":
+    main()
@@ -9,6 +9,8 @@ import geopandas as gpd
 from pathlib import Path
 import logging
 
+from utils import save_geodata
+
 # Setup logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -73,7 +75,7 @@ def create_autonomous_communities():
     output_file = PROCESSED_DIR / "spain_autonomous_communities.geojson"
     PROCESSED_DIR.mkdir(exist_ok=True)
 
-    autonomous_communities.to_file(output_file, driver='GeoJSON')
+    save_geodata(autonomous_communities, output_file)
     logger.info(f"Saved autonomous communities to: {output_file}")
 
     return autonomous_communities
@@ -103,7 +105,7 @@ def filter_mainland_communities(gdf):
 
     # Save mainland version
     output_file = PROCESSED_DIR / "mainland_spain_autonomous_communities.geojson"
-    mainland.to_file(output_file, driver='GeoJSON')
+    save_geodata(mainland, output_file)
     logger.info(f"Saved mainland communities to: {output_file}")
 
     return mainland
@@ -9,6 +9,8 @@ import pandas as pd
 from pathlib import Path
 import logging
 
+from utils import save_geodata
+
 # Setup logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
@@ -58,9 +60,9 @@ def create_mainland_spain_provinces():
     # Sort by name for consistency
     mainland_provinces = mainland_provinces.sort_values('name')
     
-    # Save as GeoJSON
+    # Save as GeoJSON plus a FlatGeobuf copy for map generation
     logger.info(f"Saving to {output_file}")
-    mainland_provinces.to_file(output_file, driver='GeoJSON')
+    save_geodata(mainland_provinces, output_file)
     
     # Print summary
     logger.info(f"Successfully created mainland Spain provinces file:")
@@ -14,6 +14,8 @@ import logging
 from tqdm import tqdm
 import click
 
+from utils import save_geodata
+
 # Setup logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
@@ -22,10 +24,6 @@ DATA_DIR = Path("data")
 RAW_DIR = DATA_DIR / "raw"
 PROCESSED_DIR = DATA_DIR / "processed"
 
-# Create directories
-RAW_DIR.mkdir(parents=True, exist_ok=True)
-PROCESSED_DIR.mkdir(parents=True, exist_ok=True)
-
 def download_file(url, filename, description=""):
     """Download a file with progress bar."""
     filepath = RAW_DIR / filename
@@ -82,8 +80,15 @@ def download_natural_earth_data():
         ("10m/cultural/ne_10m_populated_places.zip", "ne_10m_cities.zip", "Cities"),
 
         # 50m scale for overview maps
+        ("50m/physical/ne_50m_coastline.zip", "ne_50m_coastline.zip", "Coastlines (50m)"),
         ("50m/cultural/ne_50m_admin_0_countries.zip", "ne_50m_countries.zip", "Countries (50m)"),
         ("50m/cultural/ne_50m_admin_1_states_provinces.zip", "ne_50m_admin1.zip", "States/Provinces (50m)"),
+        ("50m/cultural/ne_50m_populated_places.zip", "ne_50m_cities.zip", "Cities (50m)"),
+
+        # 110m scale for continent and world maps
+        ("110m/physical/ne_110m_coastline.zip", "ne_110m_coastline.zip", "Coastlines (110m)"),
+        ("110m/cultural/ne_110m_admin_0_countries.zip", "ne_110m_countries.zip", "Countries (110m)"),
+        ("110m/cultural/ne_110m_populated_places.zip", "ne_110m_cities.zip", "Cities (110m)"),
     ]
 
     for dataset_path, filename, description in datasets:
@@ -159,7 +164,7 @@ def create_asturias_boundaries():
     }, geometry=[asturias_polygon], crs='EPSG:4326')
 
     output_path = PROCESSED_DIR / "asturias_boundary.geojson"
-    gdf.to_file(output_path, driver='GeoJSON')
+    save_geodata(gdf, output_path)
     logger.info(f"Created Asturias boundary file: {output_path}")
 
 def create_gijon_boundaries():
@@ -185,7 +190,7 @@ def create_gijon_boundaries():
     }, geometry=[bbox], crs='EPSG:4326')
 
     output_path = PROCESSED_DIR / "gijon_boundary.geojson"
-    gdf.to_file(output_path, driver='GeoJSON')
+    save_geodata(gdf, output_path)
     logger.info(f"Created Gijón boundary file: {output_path}")
 
 @click.command()
@@ -196,6 +201,10 @@ def main(skip_osm, spain_only):
 
     logger.info("Starting data download")
 
+    # Create directories
+    RAW_DIR.mkdir(parents=True, exist_ok=True)
+    PROCESSED_DIR.mkdir(parents=True, exist_ok=True)
+
     try:
         if not spain_only:
             download_natural_earth_data()
@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+"""
+File cache bounds for Wall TV Maps project.
+The layer, raster, mosaic and sprite caches keep one or more files per
+entry in their own directory. Each directory is bounded in size by
+evicting the least recently used entries, using file modification times
+as the last use, and can be cleared. Only the standard library is used,
+so the cache commands start without the rendering stack.
+"""
+
+import os
+import logging
+import threading
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+# Eviction frees space down to this fraction of the limit, so it runs rarely
+EVICTION_TARGET = 0.9
+
+class FileCache:
+    """Directory of cache entries with LRU eviction to a size limit.
+
+    An entry is every file whose name starts with the same key, up to the
+    first '.', anywhere below the directory; files still being written
+    (ending in .tmp) are left alone. Writers call added() after storing an
+    entry and readers call used() on a hit. Each process keeps its own
+    estimate of the directory size and only scans the directory when the
+    estimate goes over the limit, so several render processes may share a
+    directory.
+    """
+
+    def __init__(self, name, directory, max_mb):
+        """Initialize with a name for messages, the directory and its size limit in MB."""
+        self.name = name
+        self.directory = Path(directory)
+        self.max_bytes = max_mb * 1024 * 1024
+        self.size = None
+        self.lock = threading.Lock()
+
+    def entries(self):
+        """Scan the directory, returning {key: (paths, bytes, last use)}."""
+        entries = {}
+        if not self.directory.exists():
+            return entries
+
+        for path in self.directory.rglob('*'):
+            if path.name.endswith('.tmp'):
+                continue
+
+            try:
+                stat = path.stat()
+            except OSError:
+                # Evicted or replaced by another process meanwhile
+                continue
+
+            if not path.is_file():
+                continue
+
+            key = path.name.split('.')[0]
+            paths, size, last_use = entries.get(key, ([], 0, 0))
+            entries[key] = (paths + [path], size + stat.st_size, max(last_use, stat.st_mtime))
+
+        return entries
+
+    def used(self, path):
+        """Mark an entry's file as recently used."""
+        try:
+            os.utime(path)
+        except OSError as e:
+            # Use times only steer eviction; never fail a render over them
+            logger.debug(f"Could not mark {path} as used: {e}")
+
+    def added(self, *paths):
+        """Account for a newly stored entry, evicting old entries if the cache grows too big."""
+        size = 0
+        for path in paths:
+            try:
+                size += Path(path).stat().st_size
+            except OSError:
+                pass
+
+        with self.lock:
+            if self.size is None:
+                self.size = sum(entry[1] for entry in self.entries().values())
+            else:
+                self.size += size
+
+            if self.size > self.max_bytes:
+                self.evict()
+
+    def evict(self):
+        """Delete the least recently used entries until the cache is under its limit.
+
+        Returns the number of entries deleted.
+        """
+        entries = self.entries()
+        total = sum(entry[1] for entry in entries.values())
+        target = int(self.max_bytes * EVICTION_TARGET)
+        deleted = 0
+
+        if total > self.max_bytes:
+            for paths, size, _ in sorted(entries.values(), key=lambda entry: entry[2]):
+                if total <= target:
+                    break
+
+                self.delete(paths)
+                total -= size
+                deleted += 1
+
+            logger.info(
+                f"Evicted {deleted} {self.name} cache entries to stay under {self.max_bytes / (1024 * 1024):.0f} MB"
+            )
+
+        self.size = total
+        return deleted
+
+    def delete(self, paths):
+        """Delete the files of an entry.
+
+        Files go in name order, so an entry whose loader checks for a
+        later-named file (such as a mosaic's .json extent) stops counting as
+        cached before its data disappears.
+        """
+        for path in sorted(paths):
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+
+    def clear(self):
+        """Delete every entry. Returns the number of entries deleted."""
+        with self.lock:
+            entries = self.entries()
+            for paths, _, _ in entries.values():
+                self.delete(paths)
+
+            self.size = 0
+            return len(entries)
+
+    def info(self):
+        """Get the number of entries and their total size in bytes."""
+        entries = self.entries()
+        return len(entries), sum(entry[1] for entry in entries.values())
+
+# Shared by every map generated in this process, with their size limits in MB
+LAYER_FILES = FileCache('layer', "data/cache/layers", 1024)
+RASTER_FILES = FileCache('raster', "data/cache/rasters", 2048)
+MOSAIC_FILES = FileCache('mosaic', "data/cache/mosaics", 1024)
+SPRITE_FILES = FileCache('sprite', "data/cache/sprites", 256)
+
+FILE_CACHES = [LAYER_FILES, RASTER_FILES, MOSAIC_FILES, SPRITE_FILES]
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+"""
+Output image encoding for Wall TV Maps project.
+Encodes finished maps as PNG, WebP or JPEG on a background thread, so the
+next map can render while the previous one is being compressed.
+"""
+
+import io
+import os
+import time
+import logging
+import threading
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+# Supported codecs: Pillow format, file suffix and default save options
+CODECS = {
+    'png': {'format': 'PNG', 'suffix': '.png', 'options': {'compress_level': 6}},
+    'webp': {'format': 'WEBP', 'suffix': '.webp', 'options': {'lossless': True, 'method': 4}},
+    'jpeg': {'format': 'JPEG', 'suffix': '.jpg', 'options': {'quality': 95, 'subsampling': 0}},
+}
+
+# Codecs implied by output file suffixes
+SUFFIX_CODECS = {'.png': 'png', '.webp': 'webp', '.jpg': 'jpeg', '.jpeg': 'jpeg'}
+
+# Finished maps waiting to be encoded; each holds a full-size image in memory
+MAX_PENDING_ENCODES = 2
+
+def output_codec(encoding_config, output_file=None):
+    """Get the codec to use: the one the output file suffix names, else the configured one."""
+    codec = None
+    if output_file is not None:
+        codec = SUFFIX_CODECS.get(Path(output_file).suffix.lower())
+
+    codec = codec or encoding_config.get('codec', 'png')
+    if codec not in CODECS:
+        raise ValueError(f"Unknown codec '{codec}', expected one of {list(CODECS)}")
+
+    return codec
+
+def prepare_image(image, codec, options=None, dpi=None):
+    """Get the image to encode and the Pillow save options for a codec."""
+    save_options = {**CODECS[codec]['options'], **(options or {})}
+    if dpi is not None:
+        save_options['dpi'] = (dpi, dpi)
+
+    # An opaque map needs no alpha channel, and JPEG cannot store one
+    if image.mode == 'RGBA' and (codec == 'jpeg' or image.getextrema()[3][0] == 255):
+        image = image.convert('RGB')
+
+    return image, save_options
+
+def encode_bytes(image, codec, options=None, dpi=None):
+    """Encode an image in memory, returning the encoded bytes."""
+    image, save_options = prepare_image(image, codec, options, dpi)
+
+    buffer = io.BytesIO()
+    image.save(buffer, format=CODECS[codec]['format'], **save_options)
+    return buffer.getvalue()
+
+def encode_image(image, output_file, codec, options=None, dpi=None):
+    """Encode an image to a file, returning (seconds, bytes written).
+
+    The file is written under a temporary name and renamed into place, so
+    readers never see a partially written map.
+    """
+    output_file = Path(output_file)
+    image, save_options = prepare_image(image, codec, options, dpi)
+
+    tmp_file = output_file.with_name(f".{output_file.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    start = time.perf_counter()
+
+    try:
+        image.save(tmp_file, format=CODECS[codec]['format'], **save_options)
+        os.replace(tmp_file, output_file)
+    finally:
+        if tmp_file.exists():
+            tmp_file.unlink()
+
+    return time.perf_counter() - start, output_file.stat().st_size
+
+class BackgroundEncoder:
+    """Runs encoding jobs on a worker thread, with a bounded queue."""
+
+    def __init__(self, max_pending=MAX_PENDING_ENCODES):
+        """Initialize with the number of jobs that may wait before submit blocks."""
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='encoder')
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.futures = []
+        self.lock = threading.Lock()
+
+    def submit(self, job, *args, **kwargs):
+        """Queue a job, waiting first if too many are already pending."""
+        self.slots.acquire()
+
+        try:
+            future = self.executor.submit(job, *args, **kwargs)
+        except Exception:
+            self.slots.release()
+            raise
+
+        future.add_done_callback(lambda _: self.slots.release())
+        with self.lock:
+            self.futures.append(future)
+        return future
+
+    def wait(self):
+        """Wait for all queued jobs, raising the first error any of them hit."""
+        with self.lock:
+            futures, self.futures = self.futures, []
+
+        errors = [future.exception() for future in futures]
+        errors = [error for error in errors if error is not None]
+        if errors:
+            raise errors[0]
+
+# Shared by every map generated in this process
+ENCODER = BackgroundEncoder()
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+"""
+Label placement for Wall TV Maps project.
+Chooses non-overlapping positions for labels in priority order. Collisions
+are found with STRtree queries against the labels placed so far, so
+placement stays close to O(n log n) instead of comparing every pair.
+"""
+
+import numpy as np
+import shapely
+
+# Candidate positions tried for each label, as multiples of half its size:
+# centred on the anchor first, then above, below, right and left of it
+CANDIDATE_OFFSETS = [(0, 0), (0, 1), (0, -1), (1, 0), (-1, 0)]
+
+# Labels are placed in chunks of this many, in priority order; each chunk is
+# checked against an index of everything placed before it
+CHUNK_SIZE = 256
+
+# Bump when placement changes, to invalidate cached label rasters
+PLACEMENT_VERSION = 3
+
+class LabelPlacer:
+    """Greedy label placement that shifts or drops labels that would collide."""
+
+    def __init__(self, width, height, padding=4):
+        """Initialize with the canvas size and minimum gap between labels, in pixels."""
+        self.width = width
+        self.height = height
+        self.padding = padding
+        self.labels = []
+
+    def add(self, x, y, width, height, priority=0, group=0, shift=True, allow_overlap=False):
+        """Add a label of the given pixel size anchored at pixel (x, y).
+
+        Labels are placed group by group (lowest first), and within a group
+        by descending priority. Returns the label's id.
+        """
+        if priority is None or np.isnan(priority):
+            priority = -np.inf
+
+        self.labels.append((x, y, width, height, priority, group, shift, allow_overlap))
+        return len(self.labels) - 1
+
+    def candidate_boxes(self):
+        """Build all candidate boxes, returning (owner label, box bounds) arrays."""
+        owners = []
+        bounds = []
+
+        for label_id, (x, y, width, height, _, _, shift, _) in enumerate(self.labels):
+            half_w = width / 2 + self.padding
+            half_h = height / 2 + self.padding
+            offsets = CANDIDATE_OFFSETS if shift else CANDIDATE_OFFSETS[:1]
+
+            for dx, dy in offsets:
+                cx = x + dx * half_w
+                cy = y + dy * half_h
+                owners.append(label_id)
+                bounds.append((cx - half_w, cy - half_h, cx + half_w, cy + half_h))
+
+        return np.array(owners, dtype=int), np.array(bounds, dtype=float).reshape(-1, 4)
+
+    def place(self):
+        """Choose label positions.
+
+        Returns a list with the (x, y) pixel centre of each label, or None
+        for labels that could not be placed without overlapping. Labels
+        allowed to overlap others still have to fit on the canvas, and
+        other labels still avoid them.
+        """
+        positions = [None] * len(self.labels)
+        if not self.labels:
+            return positions
+
+        owners, bounds = self.candidate_boxes()
+        boxes = shapely.box(bounds[:, 0], bounds[:, 1], bounds[:, 2], bounds[:, 3])
+
+        # Labels hanging off the canvas are cut off, so never use those spots
+        inside = (
+            (bounds[:, 0] >= -self.padding) & (bounds[:, 1] >= -self.padding) &
+            (bounds[:, 2] <= self.width + self.padding) & (bounds[:, 3] <= self.height + self.padding)
+        )
+
+        # Candidates of labels that may overlap others
+        overlapping = np.array([label[7] for label in self.labels], dtype=bool)[owners]
+
+        first_candidate = np.searchsorted(owners, np.arange(len(self.labels)), side='left')
+        last_candidate = np.searchsorted(owners, np.arange(len(self.labels)), side='right')
+
+        # Group ascending, then priority descending, then insertion order
+        groups = np.array([label[5] for label in self.labels])
+        priorities = np.array([label[4] for label in self.labels], dtype=float)
+        label_order = np.lexsort((np.arange(len(self.labels)), -priorities, groups))
+
+        placed_boxes = []
+
+        for chunk_start in range(0, len(label_order), CHUNK_SIZE):
+            chunk = label_order[chunk_start:chunk_start + CHUNK_SIZE]
+            candidates = np.concatenate([
+                np.arange(first_candidate[label_id], last_candidate[label_id]) for label_id in chunk
+            ])
+
+            # Drop candidates that hit an already placed label. Placed labels
+            # rarely overlap, so this index stays small however many candidates there are
+            free = np.ones(len(boxes), dtype=bool)
+            if placed_boxes:
+                blocked = shapely.STRtree(placed_boxes).query(boxes[candidates], predicate='intersects')[0]
+                free[candidates[blocked]] = False
+
+            # Collisions among the remaining candidates of this chunk, and those
+            # of labels that may overlap, which are placed even where blocked
+            survivors = candidates[free[candidates] | overlapping[candidates]]
+            query, hits = shapely.STRtree(boxes[survivors]).query(boxes[survivors], predicate='intersects')
+            neighbours = {}
+            for a, b in zip(survivors[query], survivors[hits]):
+                neighbours.setdefault(a, []).append(b)
+
+            taken = set()
+
+            for label_id in chunk:
+                allow_overlap = self.labels[label_id][7]
+
+                for candidate in range(first_candidate[label_id], last_candidate[label_id]):
+                    if inside[candidate] and (allow_overlap or (
+                        free[candidate] and taken.isdisjoint(neighbours[candidate])
+                    )):
+                        taken.add(candidate)
+                        x_min, y_min, x_max, y_max = bounds[candidate]
+                        positions[label_id] = ((x_min + x_max) / 2, (y_min + y_max) / 2)
+                        break
+
+            placed_boxes.extend(boxes[sorted(taken)])
+
+        return positions
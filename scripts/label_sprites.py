@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+"""
+Label sprites for Wall TV Maps project.
+Rasterizes each distinct label (text, font, size, colours and halo) once
+and blits the resulting sprite wherever it is needed. Sprites are kept in
+memory for the whole process and on disk, so the place names that recur
+across maps of a batch are only drawn once.
+"""
+
+import os
+import json
+import hashlib
+import logging
+import threading
+from functools import lru_cache
+from collections import OrderedDict
+from matplotlib.font_manager import FontProperties, findfont
+from matplotlib.colors import to_rgba
+from PIL import Image, ImageDraw, ImageFont
+
+from file_cache import SPRITE_FILES
+
+logger = logging.getLogger(__name__)
+
+SPRITE_CACHE_DIR = SPRITE_FILES.directory
+
+# Bump when the way sprites are drawn changes, to invalidate old entries
+SPRITE_CACHE_VERSION = 1
+
+# Sprites kept in memory; enough for every label of several large maps
+SPRITE_CACHE_SIZE = 8192
+
+@lru_cache(maxsize=None)
+def font_file(font_weight):
+    """Get the font file matplotlib would use for labels of the given weight."""
+    return findfont(FontProperties(weight=font_weight))
+
+@lru_cache(maxsize=None)
+def sprite_font(font_weight, size_px):
+    """Load the label font at a pixel size."""
+    return ImageFont.truetype(font_file(font_weight), size_px)
+
+def color_bytes(color):
+    """Convert a matplotlib colour to an 8-bit RGBA tuple."""
+    return tuple(round(channel * 255) for channel in to_rgba(color))
+
+@lru_cache(maxsize=None)
+def glyph_advance(char, font_weight, size_px):
+    """Get the advance width of a character in the label font at a pixel size."""
+    return sprite_font(font_weight, size_px).getlength(char)
+
+def text_size(text, font_weight, size_px, halo_px):
+    """Get the (width, height) in pixels of a label's sprite, without drawing it.
+
+    Sums cached glyph advances of the font the sprite is drawn with instead
+    of laying out every string, which ignores kerning but keeps thousands
+    of candidate labels cheap. The height spans the font's ascent and
+    descent, so it does not depend on the letters.
+    """
+    ascent, descent = sprite_font(font_weight, size_px).getmetrics()
+    width = sum(glyph_advance(char, font_weight, size_px) for char in text)
+    return width + 2 * halo_px, ascent + descent + 2 * halo_px
+
+def draw_text(text, font_weight, size_px, color, halo_color, halo_px):
+    """Rasterize a label with its halo, tightly cropped."""
+    font = sprite_font(font_weight, size_px)
+    left, top, right, bottom = font.getbbox(text, stroke_width=halo_px)
+
+    image = Image.new('RGBA', (max(right - left, 1), max(bottom - top, 1)), (0, 0, 0, 0))
+    ImageDraw.Draw(image).text(
+        (-left, -top), text,
+        font=font,
+        fill=color_bytes(color),
+        stroke_width=halo_px,
+        stroke_fill=color_bytes(halo_color),
+    )
+    return image
+
+def draw_marker(radius_px, color, edge_color, edge_px):
+    """Rasterize a round point marker."""
+    size = 2 * (radius_px + edge_px) + 1
+    # Draw at 4x and downsample for smooth edges
+    scale = 4
+    image = Image.new('RGBA', (size * scale, size * scale), (0, 0, 0, 0))
+    ImageDraw.Draw(image).ellipse(
+        (0, 0, size * scale - 1, size * scale - 1),
+        fill=color_bytes(color),
+        outline=color_bytes(edge_color),
+        width=edge_px * scale,
+    )
+    return image.resize((size, size), Image.LANCZOS)
+
+class SpriteCache:
+    """Memory and disk cache of rasterized label sprites."""
+
+    def __init__(self, max_sprites=SPRITE_CACHE_SIZE, files=SPRITE_FILES):
+        """Initialize an empty cache holding at most max_sprites in memory, and on disk in files."""
+        self.max_sprites = max_sprites
+        self.files = files
+        self.cache_dir = files.directory
+        self.sprites = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def text(self, text, font_weight, size_px, color, halo_color, halo_px):
+        """Get the sprite of a label."""
+        key = ('text', text, font_file(font_weight), size_px, color_bytes(color), color_bytes(halo_color), halo_px)
+        return self.get(key, lambda: draw_text(text, font_weight, size_px, color, halo_color, halo_px))
+
+    def marker(self, radius_px, color, edge_color, edge_px):
+        """Get the sprite of a point marker."""
+        key = ('marker', radius_px, color_bytes(color), color_bytes(edge_color), edge_px)
+        return self.get(key, lambda: draw_marker(radius_px, color, edge_color, edge_px))
+
+    def get(self, key, draw):
+        """Get a sprite from memory, disk, or by drawing it."""
+        with self.lock:
+            sprite = self.sprites.get(key)
+            if sprite is not None:
+                self.sprites.move_to_end(key)
+                self.hits += 1
+                return sprite
+
+        path = self.sprite_path(key)
+        sprite = self.load(path)
+        if sprite is None:
+            self.misses += 1
+            sprite = draw()
+            self.store(path, sprite)
+        else:
+            self.hits += 1
+
+        with self.lock:
+            self.sprites[key] = sprite
+            while len(self.sprites) > self.max_sprites:
+                self.sprites.popitem(last=False)
+
+        return sprite
+
+    def sprite_path(self, key):
+        """Get the path of a sprite on disk."""
+        digest = hashlib.sha1(json.dumps([SPRITE_CACHE_VERSION, key]).encode('utf-8')).hexdigest()
+        return self.cache_dir / digest[:2] / f"{digest}.png"
+
+    def load(self, path):
+        """Load a sprite from disk, or return None if it is not there."""
+        if not path.exists():
+            return None
+
+        try:
+            with Image.open(path) as image:
+                image.load()
+            if image.mode != 'RGBA':
+                return None
+            self.files.used(path)
+            return image
+        except Exception as e:
+            logger.warning(f"Ignoring unreadable sprite {path}: {e}")
+            return None
+
+    def store(self, path, sprite):
+        """Store a sprite on disk."""
+        tmp_path = path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            sprite.save(tmp_path, format='PNG')
+            # Atomic rename so concurrent renders never see a partial file
+            os.replace(tmp_path, path)
+            self.files.added(path)
+        except Exception as e:
+            logger.warning(f"Could not cache sprite in {path}: {e}")
+        finally:
+            if tmp_path.exists():
+                tmp_path.unlink()
+
+def blit(canvas, sprite, x, y):
+    """Alpha-composite a sprite onto a canvas image, centred on pixel (x, y).
+
+    y counts from the top of the canvas. Sprites hanging off the canvas
+    are cropped.
+    """
+    left = round(x - sprite.width / 2)
+    top = round(y - sprite.height / 2)
+
+    # alpha_composite needs the destination inside the canvas
+    source_left = max(0, -left)
+    source_top = max(0, -top)
+    right = min(sprite.width, canvas.width - left)
+    bottom = min(sprite.height, canvas.height - top)
+    if source_left >= right or source_top >= bottom:
+        return
+
+    canvas.alpha_composite(
+        sprite,
+        dest=(left + source_left, top + source_top),
+        source=(source_left, source_top, right, bottom),
+    )
+
+# Shared by every map generated in this process
+SPRITES = SpriteCache()
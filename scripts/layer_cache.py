@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+"""
+On-disk cache of loaded layers for Wall TV Maps project.
+Stores filtered, reprojected layers as GeoParquet so later renders can
+skip shapefile parsing and reprojection, plus their label anchors.
+"""
+
+import os
+import json
+import hashlib
+import logging
+import threading
+from pathlib import Path
+import numpy as np
+import geopandas as gpd
+
+from file_cache import LAYER_FILES
+
+logger = logging.getLogger(__name__)
+
+LAYER_CACHE_DIR = LAYER_FILES.directory
+
+# Bump when the way layers are processed changes, to invalidate old entries
+LAYER_CACHE_VERSION = 2
+
+# Files that belong to a shapefile besides the .shp itself
+SHAPEFILE_SIDECARS = ['.dbf', '.shx', '.prj', '.cpg']
+
+def source_files(file_path):
+    """Get all files a layer is read from."""
+    file_path = Path(file_path)
+    files = [file_path]
+
+    if file_path.suffix.lower() == '.shp':
+        for suffix in SHAPEFILE_SIDECARS:
+            sidecar = file_path.with_suffix(suffix)
+            if sidecar.exists():
+                files.append(sidecar)
+
+    return files
+
+def source_mtime(file_path):
+    """Get the modification time of the newest file a layer is read from."""
+    return max(path.stat().st_mtime for path in source_files(file_path))
+
+def layer_cache_key(file_path, filter_expr, columns, bbox, target_crs):
+    """Compute the cache key of a layer from its source files and processing options."""
+    sources = []
+    for path in source_files(file_path):
+        stat = path.stat()
+        sources.append([str(path.resolve()), stat.st_mtime_ns, stat.st_size])
+
+    key = {
+        'version': LAYER_CACHE_VERSION,
+        'sources': sources,
+        'filter': filter_expr,
+        'columns': columns,
+        'bbox': None if bbox is None else [round(v, 3) for v in bbox],
+        'crs': str(target_crs),
+    }
+
+    return hashlib.sha1(json.dumps(key, sort_keys=True).encode('utf-8')).hexdigest()
+
+def cache_path(key):
+    """Get the path of a cached layer."""
+    return LAYER_CACHE_DIR / f"{key}.parquet"
+
+def load_cached_layer(key):
+    """Load a layer from the cache, or return None if it is not cached."""
+    path = cache_path(key)
+    if not path.exists():
+        return None
+
+    try:
+        gdf = gpd.read_parquet(path)
+        LAYER_FILES.used(path)
+        return gdf
+    except ImportError:
+        # pyarrow is optional; without it the cache is simply not used
+        return None
+    except Exception as e:
+        logger.warning(f"Ignoring unreadable layer cache entry {path}: {e}")
+        return None
+
+def store_cached_layer(key, gdf):
+    """Store a processed layer in the cache."""
+    path = cache_path(key)
+    tmp_path = path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+
+    try:
+        LAYER_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        gdf.to_parquet(tmp_path)
+        # Atomic rename so concurrent renders never see a partial file
+        os.replace(tmp_path, path)
+        LAYER_FILES.added(path)
+    except ImportError:
+        logger.debug("pyarrow not installed, layer cache disabled")
+    except Exception as e:
+        logger.warning(f"Could not cache layer in {path}: {e}")
+    finally:
+        if tmp_path.exists():
+            tmp_path.unlink()
+
+def anchor_cache_key(layer_key, strategy, extent, tolerance):
+    """Compute the cache key of a layer's label anchors."""
+    key = {
+        'layer': layer_key,
+        'strategy': strategy,
+        'extent': [round(v, 3) for v in extent],
+        'tolerance': round(tolerance, 3),
+    }
+
+    return hashlib.sha1(json.dumps(key, sort_keys=True).encode('utf-8')).hexdigest()
+
+def load_cached_anchors(key):
+    """Load cached label anchors as (index, x, y) arrays, or None if not cached."""
+    path = LAYER_CACHE_DIR / f"{key}.anchors.npz"
+    if not path.exists():
+        return None
+
+    try:
+        with np.load(path, allow_pickle=False) as anchors:
+            index, x, y = anchors['index'], anchors['x'], anchors['y']
+        LAYER_FILES.used(path)
+        return index, x, y
+    except Exception as e:
+        logger.warning(f"Ignoring unreadable anchor cache entry {path}: {e}")
+        return None
+
+def store_cached_anchors(key, index, x, y):
+    """Store label anchors of a layer in the cache."""
+    path = LAYER_CACHE_DIR / f"{key}.anchors.npz"
+    tmp_path = path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+
+    try:
+        LAYER_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, index=index, x=x, y=y)
+        os.replace(tmp_path, path)
+        LAYER_FILES.added(path)
+    except Exception as e:
+        logger.warning(f"Could not cache label anchors in {path}: {e}")
+    finally:
+        if tmp_path.exists():
+            tmp_path.unlink()
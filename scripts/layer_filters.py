@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+"""
+Translate layer filter expressions for Wall TV Maps project.
+Turns pandas query strings from the YAML configs into OGR SQL WHERE
+clauses so GDAL can filter features before they reach Python. OGR compares
+strings ignoring case, so a clause may keep more features than pandas
+would, but never fewer; the pandas query is applied on top of it.
+"""
+
+import ast
+
+# pandas comparison operators and their OGR SQL equivalents
+COMPARISON_OPERATORS = {
+    ast.Eq: '=',
+    ast.NotEq: '<>',
+    ast.Lt: '<',
+    ast.LtE: '<=',
+    ast.Gt: '>',
+    ast.GtE: '>=',
+}
+
+class UntranslatableFilter(Exception):
+    """Raised when a filter expression has no OGR SQL equivalent."""
+
+def parse_filter(filter_expr):
+    """Parse a filter expression, returning None if it is not plain Python syntax."""
+    try:
+        return ast.parse(filter_expr, mode='eval').body
+    except SyntaxError:
+        # e.g. backtick-quoted column names or @variables
+        return None
+
+def filter_columns(filter_expr):
+    """Get the column names referenced by a filter expression.
+
+    Returns None when the expression cannot be parsed, meaning that all
+    columns have to be read.
+    """
+    node = parse_filter(filter_expr)
+    if node is None:
+        return None
+
+    return sorted({n.id for n in ast.walk(node) if isinstance(n, ast.Name)})
+
+def filter_to_sql(filter_expr):
+    """Translate a pandas query expression into an OGR SQL WHERE clause.
+
+    Returns None when the expression cannot be translated; the caller
+    should then fall back to ``GeoDataFrame.query``. The clause may match
+    features the expression does not (strings that differ only in case),
+    so the caller should still apply ``GeoDataFrame.query`` to the result.
+    """
+    node = parse_filter(filter_expr)
+    if node is None:
+        return None
+
+    try:
+        return _to_sql(node)
+    except UntranslatableFilter:
+        return None
+
+def _to_sql(node):
+    """Recursively translate an expression node."""
+    if isinstance(node, ast.BoolOp):
+        joiner = ' AND ' if isinstance(node.op, ast.And) else ' OR '
+        return '(' + joiner.join(_to_sql(value) for value in node.values) + ')'
+
+    if isinstance(node, ast.BinOp) and isinstance(node.op, (ast.BitAnd, ast.BitOr)):
+        joiner = ' AND ' if isinstance(node.op, ast.BitAnd) else ' OR '
+        return f"({_to_sql(node.left)}{joiner}{_to_sql(node.right)})"
+
+    if isinstance(node, ast.Compare):
+        # Chained comparisons (1 < x < 5) become a conjunction
+        parts = []
+        left = node.left
+        for op, right in zip(node.ops, node.comparators):
+            parts.append(_comparison_to_sql(left, op, right))
+            left = right
+        return parts[0] if len(parts) == 1 else '(' + ' AND '.join(parts) + ')'
+
+    # NOT, arithmetic, function calls, ... keep pandas semantics instead
+    raise UntranslatableFilter(ast.dump(node))
+
+def _comparison_to_sql(left, op, right):
+    """Translate a single ``column <op> literal`` comparison."""
+    # Allow the literal on either side
+    if isinstance(left, ast.Name) and not isinstance(right, ast.Name):
+        column, value = left.id, right
+    elif isinstance(right, ast.Name) and not isinstance(left, ast.Name) and type(op) in COMPARISON_OPERATORS:
+        column, value = right.id, left
+        op = _mirror(op)
+    else:
+        raise UntranslatableFilter("comparison needs one column and one literal")
+
+    field = _quote_identifier(column)
+
+    if isinstance(op, (ast.In, ast.NotIn)):
+        if not isinstance(value, (ast.List, ast.Tuple, ast.Set)) or not value.elts:
+            raise UntranslatableFilter("'in' needs a non-empty literal list")
+        if isinstance(op, ast.NotIn) and any(_is_string(item) for item in value.elts):
+            raise UntranslatableFilter("'not in' with strings would drop values differing only in case")
+        items = ', '.join(_literal_to_sql(item) for item in value.elts)
+        if isinstance(op, ast.In):
+            return f"{field} IN ({items})"
+        # pandas keeps missing values for 'not in', SQL would drop them
+        return f"({field} NOT IN ({items}) OR {field} IS NULL)"
+
+    if type(op) not in COMPARISON_OPERATORS:
+        raise UntranslatableFilter(f"unsupported operator {type(op).__name__}")
+
+    # Equality ignoring case keeps every exact match, which pandas then
+    # narrows down; other string comparisons could drop features pandas keeps
+    if _is_string(value) and not isinstance(op, ast.Eq):
+        raise UntranslatableFilter(f"{type(op).__name__} on strings compares differently in OGR")
+
+    sql = f"{field} {COMPARISON_OPERATORS[type(op)]} {_literal_to_sql(value)}"
+    if isinstance(op, ast.NotEq):
+        # pandas keeps missing values for '!=', SQL would drop them
+        sql = f"({sql} OR {field} IS NULL)"
+    return sql
+
+def _mirror(op):
+    """Mirror a comparison so the column ends up on the left."""
+    mirrored = {ast.Lt: ast.Gt, ast.LtE: ast.GtE, ast.Gt: ast.Lt, ast.GtE: ast.LtE}
+    return mirrored.get(type(op), type(op))()
+
+def _is_string(node):
+    """Check whether a literal is a string."""
+    return isinstance(node, ast.Constant) and isinstance(node.value, str)
+
+def _literal_to_sql(node):
+    """Translate a literal string or number."""
+    if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.USub):
+        return '-' + _literal_to_sql(node.operand)
+
+    if not isinstance(node, ast.Constant):
+        raise UntranslatableFilter("only literal values can be compared")
+
+    value = node.value
+    if isinstance(value, str):
+        return "'" + value.replace("'", "''") + "'"
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return repr(value)
+
+    # None/True/False have different missing-value rules in SQL
+    raise UntranslatableFilter(f"unsupported literal {value!r}")
+
+def _quote_identifier(name):
+    """Quote a column name for OGR SQL."""
+    return '"' + name.replace('"', '""') + '"'
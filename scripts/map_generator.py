@@ -0,0 +1,1256 @@
+#!/usr/bin/env python3
+"""
+Map generator for Wall TV Maps project.
+Renders a YAML map configuration into a high-resolution image: loads and
+styles its layers, draws the basemap and labels, and saves the result.
+generate_map.py is the command line front end.
+"""
+
+import os
+import json
+import hashlib
+import yaml
+import logging
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+import geopandas as gpd
+import pandas as pd
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.colors import to_rgba
+import numpy as np
+import shapely
+from shapely.geometry import Point, box
+import xyzservices.providers as xyz
+from PIL import Image
+
+from basemap_tiles import DEFAULT_MAX_TILES, fetch_basemap, choose_zoom, plan_basemap
+from tile_archives import is_archive, archive_signature
+from layer_filters import filter_columns, filter_to_sql
+from label_placement import LabelPlacer, PLACEMENT_VERSION
+from label_sprites import SPRITES, SPRITE_CACHE_VERSION, blit, text_size
+from collection_renderer import draw_layer
+from layer_cache import (
+    source_files, source_mtime, layer_cache_key, load_cached_layer, store_cached_layer,
+    anchor_cache_key, load_cached_anchors, store_cached_anchors
+)
+from image_encoder import CODECS, ENCODER, output_codec, encode_image
+from render_stages import Stage, run_stages, describe_timings
+from raster_cache import raster_cache_key, load_cached_raster, store_cached_raster, composite
+from utils import binary_path
+
+logger = logging.getLogger(__name__)
+
+# Directories
+DATA_DIR = Path("data")
+OUTPUT_DIR = Path("output")
+QGIS_DIR = Path("qgis")
+
+# Output specifications
+DEFAULT_OUTPUT_WIDTH = 4000
+DEFAULT_OUTPUT_HEIGHT = 2250
+DPI = 300
+
+# Margin around the map bounds (fraction of width/height) used when filtering features at read time
+READ_BBOX_MARGIN = 0.1
+
+# Margin around the map bounds (fraction of width/height) kept when clipping layers,
+# so strokes along the map edge are not cut visibly
+CLIP_MARGIN = 0.02
+
+# Reader engine; pyogrio supports bbox, column and WHERE pushdown on all geopandas versions
+READ_ENGINE = 'pyogrio'
+
+# Maximum number of layers loaded concurrently (config: load_workers)
+LOAD_WORKERS = 4
+
+# Natural Earth datasets a layer can request by name (layer key: dataset)
+NATURAL_EARTH_DATASETS = {
+    'countries': 'raw/ne_{scale}_admin_0_countries.shp',
+    'admin1': 'raw/ne_{scale}_admin_1_states_provinces.shp',
+    'populated_places': 'raw/ne_{scale}_populated_places.shp',
+    'coastline': 'raw/ne_{scale}_coastline.shp',
+    'land': 'raw/ne_{scale}_land.shp',
+    'ocean': 'raw/ne_{scale}_ocean.shp',
+    'rivers': 'raw/ne_{scale}_rivers_lake_centerlines.shp',
+    'lakes': 'raw/ne_{scale}_lakes.shp',
+}
+
+# Approximate ground detail of each Natural Earth scale in metres
+# (0.1 mm at the nominal map scale), finest first
+NATURAL_EARTH_SCALES = {
+    '10m': 1000,
+    '50m': 5000,
+    '110m': 11000,
+}
+
+EARTH_RADIUS = 6378137  # Web Mercator sphere radius in metres
+
+# Label anchor strategies (labels: anchor)
+LABEL_ANCHORS = ['centroid', 'representative_point', 'polylabel']
+
+# Default simplification tolerance in output pixels (style: simplify)
+DEFAULT_SIMPLIFY_PIXELS = 0.5
+
+# The basemap is drawn below every layer, labels above them
+BASEMAP_ZORDER = 0
+LABEL_ZORDER = 10
+
+# Stages that draw rasters, in the order they draw rasters of equal zorder
+RASTER_STAGES = ['basemap', 'layers', 'labels']
+
+# Placement groups of hand-placed labels and points of interest; they are
+# placed before any layer label (layer groups count up from 0)
+CUSTOM_LABEL_GROUP = -2
+POINT_OF_INTEREST_GROUP = -1
+
+# Defaults for custom_labels entries (custom_label_style overrides them)
+CUSTOM_LABEL_DEFAULTS = {
+    'font_size': 12,
+    'font_weight': 'bold',
+}
+
+# Defaults for points_of_interest entries (points_of_interest_style overrides them)
+POINT_OF_INTEREST_DEFAULTS = {
+    'font_size': 9,
+    'font_color': '#222222',
+    'marker_size': 8,   # Marker diameter in points
+}
+
+# Marker colours by point of interest type
+POINT_OF_INTEREST_COLORS = {
+    'landmark': '#8e44ad',
+    'beach': '#f1c40f',
+    'university': '#2980b9',
+    'transport': '#34495e',
+    'hospital': '#c0392b',
+    'default': '#e67e22',
+}
+
+# Layer renderers: direct matplotlib collections, or GeoDataFrame.plot
+RENDERERS = ['collections', 'geopandas']
+DEFAULT_RENDERER = 'collections'
+
+# Bump when a code change alters the maps produced from the same inputs,
+# so that incremental builds do not keep outdated outputs
+GENERATOR_VERSION = 3
+
+class MapGenerator:
+    """Main class for generating maps."""
+
+    def __init__(self, config_file):
+        """Initialize with configuration file."""
+        self.config_file = Path(config_file)
+        self.reload_config()
+        self.use_layer_cache = True
+        self.use_raster_cache = True
+        self.force = False
+        self.layer_files = {}
+        self.layer_memo = {}
+
+        # Natural Earth scale last picked for each dataset, so watch mode,
+        # which resolves layer files on every poll, only logs a change
+        self.dataset_scales = {}
+
+        # What failed during the last render (layers that could not be
+        # loaded, a basemap that could not be added); the map is then
+        # degraded and its fingerprint is not recorded
+        self.failures = []
+
+        # Encoding of the last map generated, running in the background
+        self.encoding = None
+
+        # Rendered layers and basemap mosaics are large, so they are only kept
+        # in memory for the next render when asked to (watch mode)
+        self.keep_rasters = False
+        self.raster_memo = {}
+        self.mosaic_memo = {}
+        self.composite_memo = (None, None)
+
+        # Create output directory
+        OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
+
+    def reload_config(self):
+        """Load the config file and the output file it names.
+
+        Layers and rasters kept from earlier renders stay, so after an edit
+        only what the edit affects is loaded or drawn again.
+        """
+        self.config = self.load_config()
+        codec = output_codec(self.config.get('encoding', {}))
+        self.output_file = OUTPUT_DIR / f"{self.config['name']}{CODECS[codec]['suffix']}"
+
+    def load_config(self):
+        """Load configuration from YAML file."""
+        logger.info(f"Loading configuration from {self.config_file}")
+
+        with open(self.config_file, 'r', encoding='utf-8') as f:
+            config = yaml.safe_load(f)
+
+        return config
+
+    def read_bbox(self):
+        """Get the config bounds (plus margin) as a GeoSeries for spatially filtered reads."""
+        if 'bounds' not in self.config:
+            return None
+
+        bounds = self.config['bounds']
+        margin_x = (bounds['east'] - bounds['west']) * READ_BBOX_MARGIN
+        margin_y = (bounds['north'] - bounds['south']) * READ_BBOX_MARGIN
+
+        extent = box(
+            bounds['west'] - margin_x, bounds['south'] - margin_y,
+            bounds['east'] + margin_x, bounds['north'] + margin_y
+        )
+
+        # Densify the edges so the box keeps its shape when geopandas
+        # transforms it into the CRS of each source file
+        extent = extent.segmentize(max(margin_x, margin_y))
+
+        return gpd.GeoSeries([extent], crs='EPSG:3857')
+
+    def clip_extent(self):
+        """Get the padded viewport (west, south, east, north) layers are clipped to."""
+        if 'bounds' not in self.config:
+            return None
+
+        bounds = self.config['bounds']
+        margin_x = (bounds['east'] - bounds['west']) * CLIP_MARGIN
+        margin_y = (bounds['north'] - bounds['south']) * CLIP_MARGIN
+
+        return (
+            bounds['west'] - margin_x, bounds['south'] - margin_y,
+            bounds['east'] + margin_x, bounds['north'] + margin_y
+        )
+
+    def clip_layer(self, gdf, extent):
+        """Clip a layer to an extent, dropping features that fall outside it."""
+        clipped = gdf.copy()
+        clipped['geometry'] = gdf.geometry.clip_by_rect(*extent)
+
+        return clipped[~clipped.geometry.is_empty]
+
+    def read_columns(self, layer_config):
+        """Get the attribute columns a layer needs, or None to read all of them."""
+        columns = set()
+
+        if 'filter' in layer_config:
+            referenced = filter_columns(layer_config['filter'])
+            if referenced is None:
+                return None
+            columns.update(referenced)
+
+        if 'labels' in layer_config:
+            columns.add(layer_config['labels'].get('field', 'name'))
+            if 'priority' in layer_config['labels']:
+                columns.add(layer_config['labels']['priority'])
+
+        return sorted(columns)
+
+    def read_layer(self, file_path, layer_config, bbox):
+        """Read a layer, pushing the bbox, columns and filter down to the reader."""
+        columns = self.read_columns(layer_config)
+        filter_expr = layer_config.get('filter')
+        where = filter_to_sql(filter_expr) if filter_expr else None
+
+        gdf = None
+        if where is not None:
+            try:
+                gdf = gpd.read_file(file_path, bbox=bbox, columns=columns, where=where, engine=READ_ENGINE)
+                logger.info(f"Applied filter in reader: {where}")
+            except Exception as e:
+                # e.g. a field name the driver does not know; let pandas decide
+                logger.debug(f"Reader could not apply filter {where}: {e}")
+
+        if gdf is None:
+            gdf = gpd.read_file(file_path, bbox=bbox, columns=columns, engine=READ_ENGINE)
+
+        # The reader's filter may keep extra features (OGR compares strings
+        # ignoring case), so pandas has the final say
+        if filter_expr:
+            gdf = gdf.query(filter_expr)
+            logger.info(f"Applied filter: {filter_expr}")
+
+        return gdf
+
+    def ground_metres_per_pixel(self):
+        """Get the true ground distance covered by an output pixel at the map centre."""
+        if 'bounds' not in self.config:
+            return None
+
+        bounds = self.config['bounds']
+        extent = (bounds['west'], bounds['south'], bounds['east'], bounds['north'])
+
+        # Web Mercator stretches distances by 1/cos(latitude)
+        center_y = (bounds['south'] + bounds['north']) / 2
+        latitude = np.arctan(np.sinh(center_y / EARTH_RADIUS))
+
+        return self.metres_per_pixel(extent) * np.cos(latitude)
+
+    def layer_source(self, layer_config):
+        """Get the file a layer is read from, picking a Natural Earth scale for dataset layers."""
+        if 'file' in layer_config:
+            return layer_config['file']
+
+        dataset = layer_config['dataset']
+        if dataset not in NATURAL_EARTH_DATASETS:
+            raise ValueError(f"Unknown dataset '{dataset}', expected one of {list(NATURAL_EARTH_DATASETS)}")
+
+        template = NATURAL_EARTH_DATASETS[dataset]
+
+        # An explicit scale pins the resolution
+        if 'scale' in layer_config:
+            return template.format(scale=layer_config['scale'])
+
+        available = [
+            scale for scale in NATURAL_EARTH_SCALES
+            if self.resolve_layer_file(template.format(scale=scale)).exists()
+        ]
+        if not available:
+            # Let loading report the missing file
+            return template.format(scale='10m')
+
+        # Coarsest scale whose detail is still finer than a pixel, else the finest there is
+        pixel_size = self.ground_metres_per_pixel()
+        scale = available[0]
+        if pixel_size is not None:
+            sharp_enough = [s for s in available if NATURAL_EARTH_SCALES[s] <= pixel_size]
+            if sharp_enough:
+                scale = sharp_enough[-1]
+
+        if self.dataset_scales.get(dataset) != scale:
+            logger.info(f"Using Natural Earth {scale} data for dataset '{dataset}'")
+            self.dataset_scales[dataset] = scale
+
+        return template.format(scale=scale)
+
+    def resolve_layer_file(self, file_name):
+        """Get the file to read for a layer, preferring an up-to-date FlatGeobuf copy."""
+        file_path = Path(file_name)
+        if not file_path.is_absolute():
+            file_path = DATA_DIR / file_path
+
+        # Copies written by convert_data.py / save_geodata are spatially indexed;
+        # a shapefile's copy is stale once any of its sidecars changed
+        fgb_path = binary_path(file_path)
+        if fgb_path != file_path and fgb_path.exists():
+            if not file_path.exists() or fgb_path.stat().st_mtime >= source_mtime(file_path):
+                return fgb_path
+            logger.debug(f"Ignoring stale FlatGeobuf copy {fgb_path}")
+
+        return file_path
+
+    def layer_file(self, layer_name, layer_config):
+        """Get the file a layer is read from, resolving it once per map generation."""
+        if layer_name not in self.layer_files:
+            self.layer_files[layer_name] = self.resolve_layer_file(self.layer_source(layer_config))
+
+        return self.layer_files[layer_name]
+
+    def load_layer(self, layer_name, layer_config, bbox):
+        """Load a single layer, returning None if it cannot be loaded."""
+        try:
+            file_path = self.layer_file(layer_name, layer_config)
+
+            logger.info(f"Loading layer: {layer_name} from {file_path}")
+
+            if file_path.suffix.lower() not in ['.fgb', '.geojson', '.shp', '.gpkg']:
+                logger.warning(f"Unsupported file format: {file_path}")
+                self.failures.append(f"layer {layer_name}: unsupported file format")
+                return None
+
+            cache_key = layer_cache_key(
+                file_path,
+                layer_config.get('filter'),
+                self.read_columns(layer_config),
+                None if bbox is None else bbox.total_bounds.tolist(),
+                'EPSG:3857'
+            )
+
+            self.layer_keys[layer_name] = cache_key
+
+            # Layers loaded by an earlier render of this map need no reading at all
+            if cache_key in self.layer_memo:
+                logger.debug(f"Reusing loaded layer {layer_name}")
+                return self.layer_memo[cache_key]
+
+            gdf = load_cached_layer(cache_key) if self.use_layer_cache else None
+
+            if gdf is not None:
+                logger.info(f"Loaded layer {layer_name} from cache")
+                return gdf
+
+            gdf = self.read_layer(file_path, layer_config, bbox)
+
+            logger.debug(f"Layer {layer_name}: {len(gdf)} features")
+
+            # Reproject to Web Mercator for visualization
+            if gdf.crs != 'EPSG:3857':
+                gdf = gdf.to_crs('EPSG:3857')
+
+            # Drop everything that would only be drawn off-canvas
+            extent = self.clip_extent()
+            if extent is not None:
+                gdf = self.clip_layer(gdf, extent)
+
+            if self.use_layer_cache:
+                store_cached_layer(cache_key, gdf)
+
+            return gdf
+
+        except Exception as e:
+            logger.error(f"Error loading layer {layer_name}: {e}")
+            self.failures.append(f"layer {layer_name}: {e}")
+            return None
+
+    def load_data(self):
+        """Load geodata based on configuration."""
+        logger.info("Loading geodata")
+
+        self.data = {}
+        self.layer_keys = {}
+
+        # Only decode features that intersect the map area
+        bbox = self.read_bbox()
+
+        # Layers are independent, so read them concurrently; reading is
+        # mostly I/O and native decoding that releases the GIL
+        layers = list(self.config['layers'].items())
+        workers = max(1, min(self.config.get('load_workers', LOAD_WORKERS), len(layers)))
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            results = pool.map(lambda layer: self.load_layer(*layer, bbox), layers)
+
+            # pool.map keeps the config order
+            for (layer_name, _), gdf in zip(layers, results):
+                if gdf is not None:
+                    self.data[layer_name] = gdf
+
+        # Keep the loaded layers for the next render, forgetting outdated ones
+        self.layer_memo = {
+            self.layer_keys[layer_name]: gdf for layer_name, gdf in self.data.items()
+        }
+
+    def setup_map(self):
+        """Set up the matplotlib figure and axis."""
+        logger.info("Setting up map canvas")
+
+        # Calculate figure size based on output dimensions from config
+        output_width = self.config.get('output_width', DEFAULT_OUTPUT_WIDTH)
+        output_height = self.config.get('output_height', DEFAULT_OUTPUT_HEIGHT)
+
+        fig_width = output_width / DPI
+        fig_height = output_height / DPI
+
+        # Object-oriented API rather than pyplot, whose global figure state
+        # is not safe when several maps render at once
+        self.fig = Figure(
+            figsize=(fig_width, fig_height),
+            dpi=DPI,
+            facecolor=self.config.get('background_color', 'white')
+        )
+        FigureCanvasAgg(self.fig)
+        self.ax = self.fig.subplots()
+
+        # Rendered layers as (zorder, stage, RGBA array, cache key), composited by compose_map
+        self.rasters = []
+
+        # Rasters of this render by cache key, kept for the next one if keep_rasters is set
+        self.used_rasters = {}
+
+        # Remove axes and margins
+        self.ax.set_axis_off()
+        # Web Mercator units are square, as GeoDataFrame.plot would set up
+        self.ax.set_aspect('equal')
+        self.fig.subplots_adjust(left=0, bottom=0, right=1, top=1, wspace=0, hspace=0)
+
+        # Set bounds if specified
+        if 'bounds' in self.config:
+            bounds = self.config['bounds']
+            self.ax.set_xlim(bounds['west'], bounds['east'])
+            self.ax.set_ylim(bounds['south'], bounds['north'])
+        else:
+            # Calculate bounds from data
+            self.calculate_bounds()
+
+    def calculate_bounds(self):
+        """Calculate map bounds from loaded data."""
+        logger.info("Calculating map bounds")
+
+        all_bounds = []
+
+        for layer_name, gdf in self.data.items():
+            if not gdf.empty:
+                bounds = gdf.total_bounds
+                all_bounds.append(bounds)
+
+        if all_bounds:
+            # Find overall bounds
+            min_x = min(bounds[0] for bounds in all_bounds)
+            min_y = min(bounds[1] for bounds in all_bounds)
+            max_x = max(bounds[2] for bounds in all_bounds)
+            max_y = max(bounds[3] for bounds in all_bounds)
+
+            # Add padding
+            padding = 0.05  # 5% padding
+            width = max_x - min_x
+            height = max_y - min_y
+
+            self.ax.set_xlim(min_x - width * padding, max_x + width * padding)
+            self.ax.set_ylim(min_y - height * padding, max_y + height * padding)
+
+    def layer_canvas(self):
+        """Create a transparent figure and axis matching the map canvas, for one layer."""
+        output_width = self.config.get('output_width', DEFAULT_OUTPUT_WIDTH)
+        output_height = self.config.get('output_height', DEFAULT_OUTPUT_HEIGHT)
+
+        fig = Figure(figsize=(output_width / DPI, output_height / DPI), dpi=DPI)
+        FigureCanvasAgg(fig)
+        fig.patch.set_alpha(0)
+
+        ax = fig.add_axes([0, 0, 1, 1])
+        ax.set_axis_off()
+        ax.set_aspect(self.ax.get_aspect())
+        ax.set_xlim(self.ax.get_xlim())
+        ax.set_ylim(self.ax.get_ylim())
+
+        return fig, ax
+
+    def draw_raster(self, draw):
+        """Draw on a fresh layer canvas and return its pixels as an RGBA array."""
+        fig, ax = self.layer_canvas()
+        draw(ax)
+        fig.canvas.draw()
+        return np.array(fig.canvas.buffer_rgba())
+
+    def render_raster(self, name, zorder, key_parts, rasterize, stage):
+        """Render one layer to an RGBA raster, reusing the raster cache.
+
+        key_parts must describe everything the layer's pixels depend on
+        besides the canvas itself, or be None to always redraw. rasterize
+        is called without arguments and returns the layer's RGBA array.
+        stage is the render stage drawing the layer, one of RASTER_STAGES.
+        """
+        output_width = self.config.get('output_width', DEFAULT_OUTPUT_WIDTH)
+        output_height = self.config.get('output_height', DEFAULT_OUTPUT_HEIGHT)
+
+        cache_key = None
+        if self.use_raster_cache and key_parts is not None:
+            cache_key = raster_cache_key(
+                layer=key_parts,
+                extent=[round(v, 3) for v in self.ax.get_xlim() + self.ax.get_ylim()],
+                size=[output_width, output_height],
+                dpi=DPI,
+            )
+
+            rgba = self.raster_memo.get(cache_key)
+            if rgba is None:
+                rgba = load_cached_raster(cache_key, (output_width, output_height))
+
+            if rgba is not None:
+                logger.info(f"Using cached raster for {name}")
+                self.used_rasters[cache_key] = rgba
+                self.rasters.append((zorder, RASTER_STAGES.index(stage), rgba, cache_key))
+                return
+
+        rgba = rasterize()
+
+        if cache_key is not None:
+            store_cached_raster(cache_key, rgba)
+            self.used_rasters[cache_key] = rgba
+
+        self.rasters.append((zorder, RASTER_STAGES.index(stage), rgba, cache_key))
+
+    def metres_per_pixel(self, extent=None):
+        """Get the map resolution in Web Mercator metres per output pixel."""
+        output_width = self.config.get('output_width', DEFAULT_OUTPUT_WIDTH)
+        output_height = self.config.get('output_height', DEFAULT_OUTPUT_HEIGHT)
+
+        if extent is None:
+            x_min, x_max = self.ax.get_xlim()
+            y_min, y_max = self.ax.get_ylim()
+        else:
+            x_min, y_min, x_max, y_max = extent
+
+        # Use the finer axis in case the bounds do not match the output aspect ratio
+        return min((x_max - x_min) / output_width, (y_max - y_min) / output_height)
+
+    def simplify_layer(self, gdf, style):
+        """Drop vertex detail finer than the output resolution."""
+        pixels = style.get('simplify', DEFAULT_SIMPLIFY_PIXELS)
+        if not pixels or (gdf.geom_type == 'Point').all():
+            return gdf
+
+        tolerance = pixels * self.metres_per_pixel()
+
+        simplified = gdf.copy()
+        simplified['geometry'] = gdf.geometry.simplify(tolerance, preserve_topology=True)
+
+        logger.debug(
+            f"Simplified with {tolerance:.0f} m tolerance: "
+            f"{shapely.get_num_coordinates(gdf.geometry.values).sum()} -> "
+            f"{shapely.get_num_coordinates(simplified.geometry.values).sum()} vertices"
+        )
+
+        return simplified
+
+    def render_layers(self):
+        """Render all map layers."""
+        logger.info("Rendering map layers")
+
+        renderer = self.config.get('renderer', DEFAULT_RENDERER)
+        if renderer not in RENDERERS:
+            raise ValueError(f"Unknown renderer '{renderer}', expected one of {RENDERERS}")
+
+        for layer_name, layer_config in self.config['layers'].items():
+            if layer_name not in self.data:
+                continue
+
+            gdf = self.data[layer_name]
+            if gdf.empty:
+                continue
+
+            logger.info(f"Rendering layer: {layer_name}")
+
+            # Get styling options
+            style = layer_config.get('style', {})
+
+            key_parts = None
+            if layer_name in self.layer_keys:
+                key_parts = {'data': self.layer_keys[layer_name], 'style': style, 'renderer': renderer}
+
+            self.render_raster(
+                layer_name,
+                style.get('zorder', 1),
+                key_parts,
+                lambda gdf=gdf, style=style: self.draw_raster(lambda ax: self.draw_layer(ax, gdf, style, renderer)),
+                'layers'
+            )
+
+    def draw_layer(self, ax, gdf, style, renderer):
+        """Draw a single layer on the axis."""
+        gdf = self.simplify_layer(gdf, style)
+
+        # Plot the layer
+        if renderer == 'geopandas':
+            gdf.plot(
+                ax=ax,
+                color=style.get('fill_color', 'lightblue'),
+                edgecolor=style.get('stroke_color', 'black'),
+                linewidth=style.get('stroke_width', 1),
+                alpha=style.get('opacity', 1.0),
+                zorder=style.get('zorder', 1)
+            )
+        else:
+            draw_layer(ax, gdf.geometry.values, style)
+
+    def compute_anchors(self, geometry, strategy, tolerance):
+        """Compute label anchor points for a whole geometry array at once."""
+        if strategy == 'centroid':
+            return shapely.centroid(geometry)
+
+        anchors = shapely.point_on_surface(geometry)
+
+        # Halfway along lines reads better than an arbitrary vertex
+        lines = np.isin(shapely.get_type_id(geometry), [1, 5])
+        anchors[lines] = shapely.line_interpolate_point(geometry[lines], 0.5, normalized=True)
+
+        if strategy == 'polylabel':
+            # Pole of inaccessibility: the interior point farthest from the edges,
+            # which stays inside concave regions where the centroid may not
+            polygonal = np.isin(shapely.get_type_id(geometry), [3, 6])
+
+            if hasattr(shapely, 'maximum_inscribed_circle'):
+                circles = shapely.maximum_inscribed_circle(geometry[polygonal], tolerance)
+                anchors[polygonal] = shapely.get_point(circles, 0)
+            else:
+                # shapely < 2.1 has no vectorized version
+                from shapely.ops import polylabel
+                anchors[polygonal] = [
+                    polylabel(max(getattr(geom, 'geoms', [geom]), key=lambda part: part.area), tolerance)
+                    for geom in geometry[polygonal]
+                ]
+
+        return anchors
+
+    def label_anchors(self, layer_name, gdf, strategy):
+        """Get label anchor coordinates (x, y arrays) for a layer, using the anchor cache."""
+        if strategy not in LABEL_ANCHORS:
+            raise ValueError(f"Unknown label anchor '{strategy}', expected one of {LABEL_ANCHORS}")
+
+        # Anchors only need to be as precise as a pixel
+        tolerance = self.metres_per_pixel()
+
+        cache_key = None
+        if self.use_layer_cache and layer_name in self.layer_keys:
+            extent = self.ax.get_xlim() + self.ax.get_ylim()
+            cache_key = anchor_cache_key(self.layer_keys[layer_name], strategy, extent, tolerance)
+
+            cached = load_cached_anchors(cache_key)
+            if cached is not None and np.array_equal(cached[0], gdf.index.to_numpy()):
+                logger.debug(f"Loaded label anchors for {layer_name} from cache")
+                return cached[1], cached[2]
+
+        anchors = self.compute_anchors(np.asarray(gdf.geometry.values), strategy, tolerance)
+        x, y = shapely.get_x(anchors), shapely.get_y(anchors)
+
+        if cache_key is not None:
+            store_cached_anchors(cache_key, gdf.index.to_numpy(), x, y)
+
+        return x, y
+
+    def add_labels(self):
+        """Add labels to the map, dropping or shifting those that would overlap."""
+        logger.info("Adding labels")
+
+        labelled = [
+            (layer_name, self.layer_keys.get(layer_name), layer_config['labels'])
+            for layer_name, layer_config in self.config['layers'].items()
+            if 'labels' in layer_config and layer_name in self.data
+        ]
+        custom_labels = self.config.get('custom_labels') or []
+        points_of_interest = self.config.get('points_of_interest') or []
+
+        if not (labelled or custom_labels or points_of_interest):
+            return
+
+        # Placement depends on every labelled layer, so they share one raster
+        key_parts = None
+        if all(layer_key is not None for _, layer_key, _ in labelled):
+            key_parts = {
+                'labels': labelled,
+                'custom_labels': [custom_labels, self.config.get('custom_label_style', {})],
+                'points_of_interest': [points_of_interest, self.config.get('points_of_interest_style', {})],
+                'sprites': SPRITE_CACHE_VERSION,
+                'placement': PLACEMENT_VERSION,
+            }
+
+        self.render_raster('labels', LABEL_ZORDER, key_parts, self.draw_labels, 'labels')
+
+    def label_style(self, label_config):
+        """Get the font and halo settings of a label configuration."""
+        font_color = label_config.get('font_color', 'black')
+        outline_color = label_config.get('outline_color', 'auto')
+
+        # Auto-determine outline color based on font color
+        if outline_color == 'auto':
+            if font_color.lower() in ['white', '#ffffff', '#fff']:
+                outline_color = 'black'
+            else:
+                outline_color = 'white'
+
+        return {
+            'font_size': label_config.get('font_size', 12),
+            'font_color': font_color,
+            'font_weight': label_config.get('font_weight', 'normal'),
+            'outline_width': label_config.get('outline_width', 3),
+            'outline_color': outline_color,
+        }
+
+    def label_size(self, text, style):
+        """Get the pixel size of a label drawn in the given style, as label_sprite draws it."""
+        return text_size(
+            str(text),
+            style['font_weight'],
+            round(style['font_size'] * DPI / 72),
+            round(style['outline_width'] / 2 * DPI / 72),
+        )
+
+    def label_sprite(self, text, style):
+        """Get the sprite of a label drawn in the given style."""
+        # Sizes are in points; the halo extends half the outline width outwards
+        return SPRITES.text(
+            str(text),
+            style['font_weight'],
+            round(style['font_size'] * DPI / 72),
+            style['font_color'],
+            style['outline_color'],
+            round(style['outline_width'] / 2 * DPI / 72),
+        )
+
+    def draw_labels(self):
+        """Place all labels and blit their sprites onto a transparent raster."""
+        output_width = self.config.get('output_width', DEFAULT_OUTPUT_WIDTH)
+        output_height = self.config.get('output_height', DEFAULT_OUTPUT_HEIGHT)
+
+        # Figure pixels are output pixels, since the figure is drawn at DPI
+        self.ax.apply_aspect()
+        to_pixels = self.ax.transData
+
+        placer = LabelPlacer(output_width, output_height)
+        candidates = []
+        markers = []
+
+        # Hand-placed labels go first and always stay where they were put
+        custom_style = {**CUSTOM_LABEL_DEFAULTS, **self.config.get('custom_label_style', {})}
+        for custom_label in self.config.get('custom_labels') or []:
+            label_config = {**custom_style, **custom_label}
+            style = self.label_style(label_config)
+            text = custom_label.get('text', custom_label.get('name'))
+            (x, y), = to_pixels.transform([custom_label['position']])
+
+            width, height = self.label_size(text, style)
+            label_id = placer.add(
+                x, y, width, height,
+                group=CUSTOM_LABEL_GROUP,
+                shift=label_config.get('shift', False),
+                allow_overlap=label_config.get('allow_overlap', True)
+            )
+            candidates.append((label_id, text, style))
+
+        # Points of interest get a marker, and a label to its right when there is room
+        poi_style = {**POINT_OF_INTEREST_DEFAULTS, **self.config.get('points_of_interest_style', {})}
+        for point in self.config.get('points_of_interest') or []:
+            label_config = {**poi_style, **point}
+            style = self.label_style(label_config)
+            (x, y), = to_pixels.transform([point['position']])
+
+            radius = round(label_config['marker_size'] / 2 * DPI / 72)
+            color = label_config.get('marker_color', POINT_OF_INTEREST_COLORS.get(point.get('type'), POINT_OF_INTEREST_COLORS['default']))
+            markers.append((x, y, SPRITES.marker(radius, color, style['outline_color'], max(1, round(DPI / 72)))))
+
+            text = point.get('label', point.get('name'))
+            if not text:
+                continue
+
+            width, height = self.label_size(text, style)
+            label_id = placer.add(
+                x + radius + width / 2, y, width, height,
+                group=POINT_OF_INTEREST_GROUP,
+                shift=label_config.get('shift', False),
+                allow_overlap=label_config.get('allow_overlap', False)
+            )
+            candidates.append((label_id, text, style))
+
+        for layer_index, (layer_name, layer_config) in enumerate(self.config['layers'].items()):
+            if layer_name not in self.data:
+                continue
+
+            if 'labels' not in layer_config:
+                continue
+
+            gdf = self.data[layer_name]
+            if gdf.empty:
+                continue
+
+            # Anchor labels on the part of each feature that is actually visible
+            x_min, x_max = self.ax.get_xlim()
+            y_min, y_max = self.ax.get_ylim()
+            gdf = self.clip_layer(gdf, (x_min, y_min, x_max, y_max))
+
+            label_config = layer_config['labels']
+
+            # Get label field
+            label_field = label_config.get('field', 'name')
+            if label_field not in gdf.columns:
+                logger.warning(f"Label field '{label_field}' not found in {layer_name}")
+                continue
+
+            style = self.label_style(label_config)
+
+            # Compute all anchors of the layer at once
+            anchor_x, anchor_y = self.label_anchors(layer_name, gdf, label_config.get('anchor', 'centroid'))
+
+            has_label = gdf[label_field].notna().to_numpy()
+            anchors = to_pixels.transform(np.column_stack([anchor_x[has_label], anchor_y[has_label]]))
+
+            # Higher values win when labels collide, e.g. POP_MAX for cities
+            priority_field = label_config.get('priority')
+            if priority_field and priority_field in gdf.columns:
+                priorities = pd.to_numeric(gdf[priority_field][has_label], errors='coerce').to_numpy()
+            else:
+                if priority_field:
+                    logger.warning(f"Priority field '{priority_field}' not found in {layer_name}")
+                priorities = np.zeros(len(anchors))
+
+            for label, (x, y), priority in zip(gdf[label_field][has_label], anchors, priorities):
+                width, height = self.label_size(label, style)
+                label_id = placer.add(
+                    x, y, width, height,
+                    priority=priority,
+                    group=layer_index,
+                    shift=label_config.get('shift', True),
+                    allow_overlap=label_config.get('allow_overlap', False)
+                )
+                candidates.append((label_id, label, style))
+
+        positions = placer.place()
+
+        # Pixel coordinates count upwards, image rows downwards
+        canvas = Image.new('RGBA', (output_width, output_height), (0, 0, 0, 0))
+
+        for x, y, sprite in markers:
+            blit(canvas, sprite, x, output_height - y)
+
+        placed = 0
+        for label_id, label, style in candidates:
+            if positions[label_id] is None:
+                continue
+
+            x, y = positions[label_id]
+            blit(canvas, self.label_sprite(label, style), x, output_height - y)
+            placed += 1
+
+        logger.info(f"Placed {placed} of {len(candidates)} labels")
+        logger.debug(f"Label sprites: {SPRITES.hits} cached, {SPRITES.misses} drawn")
+
+        return np.asarray(canvas)
+
+    def basemap_source(self, source_name):
+        """Get the tile source for a configured basemap, with API keys for providers that require them."""
+        source = source_name
+
+        # Stadia Maps API key handling
+        if 'Stadia.' in source_name:
+            api_key = os.getenv('STADIA_API_KEY')
+            if api_key:
+                # Create provider object with API key for Stadia Maps
+                provider_parts = source_name.split('.')
+                if len(provider_parts) == 2:
+                    provider_group = getattr(xyz, provider_parts[0])
+                    provider_class = getattr(provider_group, provider_parts[1])
+                    source = provider_class(api_key=api_key)
+                    # Modify URL to include API key as per Stadia docs
+                    source["url"] = source["url"] + "?api_key={api_key}"
+                    logger.info("Using Stadia API key from environment")
+                else:
+                    logger.warning(f"Invalid Stadia provider format: {source_name}")
+            else:
+                logger.warning("STADIA_API_KEY not found in environment")
+
+        # Thunderforest API key handling
+        elif 'Thunderforest.' in source_name:
+            api_key = os.getenv('THUNDERFOREST_API_KEY')
+            if api_key and api_key != 'none-yet':
+                # Get the provider and set the API key
+                provider_parts = source_name.split('.')
+                if len(provider_parts) == 2:
+                    provider_group = getattr(xyz, provider_parts[0])
+                    source = getattr(provider_group, provider_parts[1]).copy()
+                    source['apikey'] = api_key
+                    logger.info("Using Thunderforest API key from environment")
+                else:
+                    logger.warning(f"Invalid Thunderforest provider format: {source_name}")
+            else:
+                logger.warning("THUNDERFOREST_API_KEY not found in environment or set to 'none-yet'")
+
+        return source
+
+    def map_extent(self):
+        """Get the map extent as (x_min, y_min, x_max, y_max)."""
+        x_min, x_max = self.ax.get_xlim()
+        y_min, y_max = self.ax.get_ylim()
+        return x_min, y_min, x_max, y_max
+
+    def basemap_zoom(self, source, basemap_config):
+        """Get the basemap zoom level to render, within the map's tile budget."""
+        return choose_zoom(
+            source,
+            self.map_extent(),
+            zoom=basemap_config.get('zoom', 'auto'),
+            metres_per_pixel=self.metres_per_pixel(),
+            max_tiles=basemap_config.get('max_tiles', DEFAULT_MAX_TILES),
+            max_bytes=basemap_config.get('max_bytes'),
+        )
+
+    def add_basemap(self):
+        """Add a basemap if specified."""
+        if 'basemap' in self.config:
+            basemap_config = self.config['basemap']
+
+            try:
+                logger.info(f"Adding basemap: {basemap_config['source']}")
+
+                source_name = basemap_config['source']
+                source = self.basemap_source(source_name)
+                zoom = self.basemap_zoom(source, basemap_config)
+
+                key_parts = {
+                    'basemap': source_name,
+                    'alpha': basemap_config.get('alpha', 1.0),
+                    'zoom': zoom,
+                }
+                if is_archive(source_name):
+                    # A rebuilt archive may hold different tiles under the same name
+                    key_parts['archive'] = archive_signature(source_name)
+
+                self.render_raster('basemap', BASEMAP_ZORDER, key_parts, lambda: self.draw_raster(
+                    lambda ax: self.draw_basemap(ax, source, basemap_config, zoom)
+                ), 'basemap')
+
+                logger.info("Basemap added successfully")
+
+            except Exception as e:
+                logger.warning(f"Failed to add basemap: {e}")
+                self.failures.append(f"basemap: {e}")
+
+    def draw_basemap(self, ax, source, basemap_config, zoom):
+        """Fetch the basemap tiles covering the axis at a zoom level and draw their mosaic."""
+        x_min, x_max = ax.get_xlim()
+        y_min, y_max = ax.get_ylim()
+
+        # Download tuning: parallel downloads, requests per second, retries
+        options = {key: basemap_config[key] for key in ['workers', 'rate_limit', 'retries'] if key in basemap_config}
+
+        # A mosaic kept from the previous render serves a basemap restyled over the same area
+        mosaic_key = (str(source), zoom, x_min, y_min, x_max, y_max)
+        mosaic = self.mosaic_memo.get(mosaic_key)
+
+        if mosaic is None:
+            # All tiles are downloaded up front, in parallel, before the mosaic is built;
+            # the zoom is already within the tile budget
+            mosaic = fetch_basemap(
+                source,
+                (x_min, y_min, x_max, y_max),
+                zoom=zoom,
+                max_tiles=None,
+                use_cache=self.use_raster_cache,
+                **options
+            )
+
+            if self.keep_rasters:
+                self.mosaic_memo = {mosaic_key: mosaic}
+
+        image, extent = mosaic
+
+        ax.imshow(image, extent=extent, alpha=basemap_config.get('alpha', 1.0), interpolation='bilinear')
+
+        # The mosaic covers whole tiles; keep the map extent
+        ax.set_xlim(x_min, x_max)
+        ax.set_ylim(y_min, y_max)
+
+    def basemap_plan(self):
+        """Describe the tiles each basemap zoom level would need, without downloading anything."""
+        basemap_config = self.config.get('basemap')
+        if not basemap_config:
+            return f"{self.config['name']}: no basemap"
+
+        # Bounds may have to come from the data
+        if 'bounds' not in self.config:
+            self.load_data()
+        self.setup_map()
+
+        source = self.basemap_source(basemap_config['source'])
+        metres_per_pixel = self.metres_per_pixel()
+        max_tiles = basemap_config.get('max_tiles', DEFAULT_MAX_TILES)
+        max_bytes = basemap_config.get('max_bytes')
+
+        chosen, rows = plan_basemap(
+            source,
+            self.map_extent(),
+            zoom=basemap_config.get('zoom', 'auto'),
+            metres_per_pixel=metres_per_pixel,
+            max_tiles=max_tiles,
+            max_bytes=max_bytes,
+        )
+        self.fig = None
+
+        budget = f"{max_tiles} tiles" if max_tiles is not None else "no tile limit"
+        if max_bytes is not None:
+            budget += f", {max_bytes / (1024 * 1024):.0f} MB"
+
+        lines = [
+            f"{self.config['name']}: basemap {basemap_config['source']}, zoom {basemap_config.get('zoom', 'auto')}, "
+            f"{metres_per_pixel:.0f} m per output pixel, budget {budget}",
+            f"  {'zoom':>4} {'tiles':>8} {'est. MB':>8} {'tile px per output px':>22}",
+        ]
+        for row in rows:
+            notes = []
+            if row['requested']:
+                notes.append('requested')
+            if row['zoom'] == chosen:
+                notes.append('rendered' + (f", {row['cached']} cached" if row.get('cached') is not None else ''))
+            if row['over_budget']:
+                notes.append('over budget')
+
+            scale = f"{row['scale']:.2f}" if row['scale'] is not None else '-'
+            lines.append(
+                f"  {row['zoom']:>4} {row['tiles']:>8} {row['bytes'] / (1024 * 1024):>8.1f} {scale:>22}"
+                + (f"  <- {', '.join(notes)}" if notes else '')
+            )
+
+        return "\n".join(lines)
+
+    def compose_map(self):
+        """Composite the rendered layers over the background into the final image."""
+        output_width = self.config.get('output_width', DEFAULT_OUTPUT_WIDTH)
+        output_height = self.config.get('output_height', DEFAULT_OUTPUT_HEIGHT)
+
+        background_color = to_rgba(self.config.get('background_color', 'white'))
+
+        # Stages append concurrently, so equal zorders are ordered by stage; the
+        # sort is stable, so layers of one stage keep their drawing order
+        rasters = sorted(self.rasters, key=lambda raster: raster[:2])
+
+        # Everything below the first label raster rarely changes while labels are
+        # tuned, so with keep_rasters its composite is kept for the next render
+        labels = RASTER_STAGES.index('labels')
+        split = next((i for i, raster in enumerate(rasters) if raster[1] == labels), len(rasters))
+        below_key = (output_width, output_height, background_color, [raster[3] for raster in rasters[:split]])
+        reusable = self.keep_rasters and None not in below_key[3]
+
+        if reusable and self.composite_memo[0] == below_key:
+            below = self.composite_memo[1]
+        else:
+            background = Image.new(
+                'RGBA',
+                (output_width, output_height),
+                tuple(round(channel * 255) for channel in background_color)
+            )
+            below = composite(background, [raster[2] for raster in rasters[:split]])
+            self.composite_memo = (below_key, below) if reusable else (None, None)
+
+        # composite works on a copy, so the kept composite stays as it is
+        image = composite(below, [raster[2] for raster in rasters[split:]])
+
+        # Keep this render's rasters for the next one, forgetting outdated ones
+        if self.keep_rasters:
+            self.raster_memo = self.used_rasters
+
+        # Drop the canvas and layers to free memory
+        self.fig = None
+        self.rasters = []
+        self.used_rasters = {}
+
+        return image
+
+    def render(self):
+        """Render the map and return it as an image.
+
+        The steps run as stages with explicit dependencies: the basemap only
+        needs the canvas, so its tiles are fetched while the layers load.
+        Layers or a basemap that fail are left out and listed in
+        self.failures.
+        """
+        images = []
+        self.failures = []
+
+        # Without configured bounds, the canvas extent comes from the data
+        bounds_from_data = 'bounds' not in self.config
+
+        timings = run_stages([
+            Stage('load_data', self.load_data, []),
+            Stage('setup_map', self.setup_map, ['load_data'] if bounds_from_data else []),
+            Stage('basemap', self.add_basemap, ['setup_map']),
+            Stage('layers', self.render_layers, ['load_data', 'setup_map']),
+            Stage('labels', self.add_labels, ['load_data', 'setup_map']),
+            Stage('compose', lambda: images.append(self.compose_map()), ['basemap', 'layers', 'labels']),
+        ])
+
+        logger.info(f"Render stages: {describe_timings(timings)}")
+        return images[0]
+
+    def save_map(self, image, fingerprint=None):
+        """Queue a rendered map for encoding to the output file.
+
+        Encoding runs on a background thread; call ENCODER.wait() before
+        exiting to make sure every map is written. The fingerprint, if
+        given, is recorded once the map itself is written. Returns the
+        future of the encode.
+        """
+        logger.info(f"Saving map to {self.output_file}")
+
+        encoding_config = dict(self.config.get('encoding', {}))
+        codec = output_codec(encoding_config, self.output_file)
+        encoding_config.pop('codec', None)
+
+        return ENCODER.submit(self.encode_map, image, self.output_file, codec, encoding_config, fingerprint)
+
+    def encode_map(self, image, output_file, codec, options, fingerprint):
+        """Encode a finished map and record its fingerprint."""
+        elapsed, size = encode_image(image, output_file, codec, options, dpi=DPI)
+
+        if fingerprint is not None:
+            output_file.with_name(output_file.name + '.fingerprint').write_text(fingerprint + '\n', encoding='utf-8')
+
+        logger.info(f"Map saved successfully: {output_file} ({codec}, {size / (1024 * 1024):.1f} MB, encoded in {elapsed:.2f}s)")
+
+    def fingerprint(self):
+        """Compute a fingerprint of everything the output map depends on.
+
+        Also re-resolves the files layers are read from, since they may
+        have changed since the last map was generated.
+        """
+        self.layer_files = {}
+
+        inputs = {}
+        for layer_name, layer_config in self.config['layers'].items():
+            try:
+                file_path = self.layer_file(layer_name, layer_config)
+            except Exception as e:
+                # Loading will report the problem; just make sure it is noticed
+                inputs[layer_name] = str(e)
+                continue
+
+            inputs[layer_name] = [
+                [str(path), path.stat().st_mtime_ns, path.stat().st_size] if path.exists() else [str(path), None]
+                for path in source_files(file_path)
+            ]
+
+        basemap_config = self.config.get('basemap', {})
+        basemap = [basemap_config.get('source'), basemap_config.get('zoom', 'auto')]
+        if is_archive(basemap[0]):
+            basemap.append(archive_signature(basemap[0]))
+
+        fingerprint = {
+            'version': GENERATOR_VERSION,
+            'config': self.config,
+            'inputs': inputs,
+            'basemap': basemap,
+            'output': [
+                self.output_file.suffix.lower(),
+                self.config.get('output_width', DEFAULT_OUTPUT_WIDTH),
+                self.config.get('output_height', DEFAULT_OUTPUT_HEIGHT),
+            ],
+        }
+
+        return hashlib.sha256(json.dumps(fingerprint, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+    def fingerprint_file(self):
+        """Get the file storing the fingerprint of the output map."""
+        return self.output_file.with_name(self.output_file.name + '.fingerprint')
+
+    def is_up_to_date(self, fingerprint):
+        """Check whether the output map exists and was built from the same inputs."""
+        fingerprint_file = self.fingerprint_file()
+        if not self.output_file.exists() or not fingerprint_file.exists():
+            return False
+
+        return fingerprint_file.read_text(encoding='utf-8').strip() == fingerprint
+
+    def generate(self):
+        """Generate the complete map.
+
+        Returns False if the map was skipped because it is already up to
+        date, True otherwise. A map rendered without some of its layers or
+        its basemap (see self.failures) is saved without a fingerprint, so
+        the next run renders it again. The map is encoded in the background;
+        self.encoding is the future of the encode.
+        """
+        self.encoding = None
+
+        fingerprint = self.fingerprint()
+        if not self.force and self.is_up_to_date(fingerprint):
+            logger.info(f"Map is up to date, skipping: {self.output_file}")
+            return False
+
+        logger.info(f"Generating map: {self.config['name']}")
+
+        try:
+            image = self.render()
+
+            if self.failures:
+                logger.warning(
+                    f"Map {self.config['name']} is degraded, not recording its fingerprint: {'; '.join(self.failures)}"
+                )
+                fingerprint = None
+                self.fingerprint_file().unlink(missing_ok=True)
+
+            self.encoding = self.save_map(image, fingerprint)
+
+            logger.info(f"Map generation complete: {self.config['name']}" + (" (degraded)" if self.failures else ""))
+            return True
+
+        except Exception as e:
+            logger.error(f"Error generating map: {e}")
+            raise
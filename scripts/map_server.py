@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+"""
+HTTP map server for Wall TV Maps project.
+Keeps map generators, their loaded layers and recently rendered images in
+memory, and serves maps as /maps/<config>.png?width=&height= so a display
+can fetch them without paying start-up and data loading costs each time.
+"""
+
+import json
+import logging
+import threading
+from pathlib import Path
+from collections import OrderedDict
+from http import HTTPStatus
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+
+from image_encoder import CODECS, SUFFIX_CODECS, encode_bytes
+from batch_render import map_configs
+
+logger = logging.getLogger(__name__)
+
+CONFIG_DIR = Path("config")
+
+# Memory for rendered images, in MB
+DEFAULT_CACHE_MB = 256
+
+# Largest width or height a client may ask for, in pixels
+MAX_DIMENSION = 8000
+
+CONTENT_TYPES = {'png': 'image/png', 'webp': 'image/webp', 'jpeg': 'image/jpeg'}
+
+class RenderCache:
+    """LRU of encoded maps, bounded by their total size in bytes."""
+
+    def __init__(self, max_bytes):
+        """Initialize an empty cache holding at most max_bytes of images."""
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """Get an encoded map, or None if it is not cached."""
+        with self.lock:
+            body = self.entries.get(key)
+            if body is not None:
+                self.entries.move_to_end(key)
+            return body
+
+    def put(self, key, body):
+        """Add an encoded map, evicting the least recently used ones to make room."""
+        if len(body) > self.max_bytes:
+            return
+
+        with self.lock:
+            if key in self.entries:
+                self.size -= len(self.entries.pop(key))
+
+            self.entries[key] = body
+            self.size += len(body)
+
+            while self.size > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+
+class MapServer(ThreadingHTTPServer):
+    """Threaded HTTP server rendering maps on demand."""
+
+    daemon_threads = True
+
+    def __init__(self, address, generator_factory, cache_bytes, config_dir=CONFIG_DIR):
+        """Initialize with a callable creating a map generator from a config file."""
+        super().__init__(address, MapRequestHandler)
+        self.generator_factory = generator_factory
+        self.config_dir = Path(config_dir)
+        self.cache = RenderCache(cache_bytes)
+
+        # One warm generator per config, with its config as loaded from disk
+        self.generators = {}
+
+        # Requests for the same config wait for each other instead of rendering twice
+        self.locks = {}
+        self.locks_lock = threading.Lock()
+
+        # Map configs found in config_dir, and the files and times they were found from
+        self.maps = []
+        self.scanned = None
+        self.maps_lock = threading.Lock()
+
+    def available_maps(self):
+        """Get the names of all configs that can be served.
+
+        YAML files that are not maps, such as collections of snippets, are
+        left out the way --all leaves them out. The configs are only read
+        again when a file in config_dir changed.
+        """
+        paths = sorted(self.config_dir.glob('*.yaml'))
+        scanned = []
+        for path in paths:
+            try:
+                scanned.append((path, path.stat().st_mtime_ns))
+            except OSError:
+                continue
+
+        with self.maps_lock:
+            if scanned != self.scanned:
+                self.scanned = scanned
+                self.maps = sorted(path.stem for path in map_configs([path for path, _ in scanned]))
+            return self.maps
+
+    def config_lock(self, name):
+        """Get the lock serializing renders of a config."""
+        with self.locks_lock:
+            return self.locks.setdefault(name, threading.Lock())
+
+    def generator(self, name):
+        """Get the generator of a config, reloading the config if its file changed.
+
+        Must be called with the config's lock held.
+        """
+        config_file = self.config_dir / f"{name}.yaml"
+        mtime = config_file.stat().st_mtime_ns
+
+        if name not in self.generators:
+            generator = self.generator_factory(config_file)
+            self.generators[name] = [generator, generator.config, mtime]
+        elif self.generators[name][2] != mtime:
+            generator = self.generators[name][0]
+            self.generators[name][1:] = [generator.load_config(), mtime]
+
+        return self.generators[name]
+
+    def render(self, name, codec, width=None, height=None, etag=None):
+        """Render a map, or get it from the cache.
+
+        Returns (etag, body). body is None when etag is given and still
+        matches, so the client's copy can be reused. A map rendered without
+        some of its layers or its basemap is neither cached nor given an
+        etag, so the next request renders it again.
+        """
+        with self.config_lock(name):
+            generator, config, _ = self.generator(name)
+
+            generator.config = dict(config)
+            if width is not None:
+                generator.config['output_width'] = width
+            if height is not None:
+                generator.config['output_height'] = height
+            generator.output_file = Path(f"{name}{CODECS[codec]['suffix']}")
+
+            # The fingerprint covers the config, the size and format, and every input file
+            current_etag = '"' + generator.fingerprint()[:32] + '"'
+            if etag == current_etag:
+                return current_etag, None
+
+            body = self.cache.get(current_etag)
+            if body is None:
+                logger.info(f"Rendering {name} ({codec}, {width or 'default'}x{height or 'default'})")
+                image = generator.render()
+
+                options = dict(generator.config.get('encoding', {}))
+                options.pop('codec', None)
+                body = encode_bytes(image, codec, options)
+
+                if generator.failures:
+                    logger.warning(f"Not caching degraded {name}: {'; '.join(generator.failures)}")
+                    return None, body
+
+                self.cache.put(current_etag, body)
+
+            return current_etag, body
+
+class MapRequestHandler(BaseHTTPRequestHandler):
+    """Serves /maps (the list of configs) and /maps/<config>.<png|webp|jpg>."""
+
+    def do_GET(self):
+        """Handle a GET request."""
+        url = urlsplit(self.path)
+        parts = [part for part in url.path.split('/') if part]
+
+        if parts == ['maps']:
+            self.send_json({'maps': self.server.available_maps()})
+            return
+
+        if len(parts) != 2 or parts[0] != 'maps':
+            self.send_error(HTTPStatus.NOT_FOUND)
+            return
+
+        name, _, suffix = parts[1].rpartition('.')
+        codec = SUFFIX_CODECS.get(f".{suffix.lower()}")
+        if codec is None or name not in self.server.available_maps():
+            self.send_error(HTTPStatus.NOT_FOUND, f"No map {parts[1]}")
+            return
+
+        try:
+            query = parse_qs(url.query)
+            width = self.dimension(query, 'width')
+            height = self.dimension(query, 'height')
+        except ValueError as e:
+            self.send_error(HTTPStatus.BAD_REQUEST, str(e))
+            return
+
+        try:
+            etag, body = self.server.render(name, codec, width, height, self.headers.get('If-None-Match'))
+        except Exception as e:
+            logger.exception(f"Failed to render {name}")
+            self.send_error(HTTPStatus.INTERNAL_SERVER_ERROR, str(e))
+            return
+
+        if body is None:
+            self.send_response(HTTPStatus.NOT_MODIFIED)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+
+        self.send_response(HTTPStatus.OK)
+        self.send_header('Content-Type', CONTENT_TYPES[codec])
+        self.send_header('Content-Length', str(len(body)))
+        if etag is not None:
+            self.send_header('ETag', etag)
+            # Let clients keep the image, but check back since inputs may change
+            self.send_header('Cache-Control', 'no-cache')
+        else:
+            # A degraded map should be fetched again
+            self.send_header('Cache-Control', 'no-store')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def dimension(self, query, name):
+        """Parse a width or height query parameter."""
+        if name not in query:
+            return None
+
+        value = query[name][-1]
+        if not value.isdigit() or not 1 <= int(value) <= MAX_DIMENSION:
+            raise ValueError(f"{name} must be an integer between 1 and {MAX_DIMENSION}")
+        return int(value)
+
+    def send_json(self, data):
+        """Send a JSON response."""
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(HTTPStatus.OK)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        """Log requests through logging instead of stderr."""
+        logger.info(f"{self.address_string()} - {format % args}")
+
+def serve(generator_factory, host='127.0.0.1', port=8000, cache_mb=DEFAULT_CACHE_MB, config_dir=CONFIG_DIR):
+    """Serve maps over HTTP until interrupted."""
+    server = MapServer((host, port), generator_factory, cache_mb * 1024 * 1024, config_dir)
+    logger.info(f"Serving maps on http://{host}:{port}/maps ({cache_mb} MB image cache)")
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logger.info("Shutting down")
+    finally:
+        server.server_close()
@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+"""
+Watch mode for Wall TV Maps project.
+Keeps a warm generator for each map config and re-renders a map shortly
+after its config or any file it is rendered from stops changing. Loaded
+layers, rendered layers and basemap mosaics stay in memory between
+renders, so an edit only redraws what it affects.
+"""
+
+import time
+import logging
+from pathlib import Path
+
+from batch_render import map_configs, describe_error
+from image_encoder import ENCODER
+
+logger = logging.getLogger(__name__)
+
+CONFIG_DIR = Path("config")
+
+# How often configs and input files are checked for changes, in seconds
+POLL_INTERVAL = 0.1
+
+# How long a map's inputs must stay unchanged before it is re-rendered, in
+# seconds, so a burst of saves renders once
+DEBOUNCE = 0.2
+
+class WatchedMap:
+    """A watched config: its generator and the fingerprints it was rendered from or is waiting on."""
+
+    def __init__(self, config_file):
+        """Initialize with the config file, before anything is loaded."""
+        self.config_file = Path(config_file)
+        self.generator = None
+        self.config_mtime = None
+        self.broken = False
+        self.rendered = None
+        self.pending = None
+        self.pending_since = None
+
+class MapWatcher:
+    """Polls map configs and their inputs, re-rendering the maps that changed.
+
+    Changes are found through each map's fingerprint, which covers its
+    config and the modification time and size of every input file.
+    """
+
+    def __init__(self, generator_factory, configs=None, settings=None, config_dir=CONFIG_DIR):
+        """Initialize with a callable creating a map generator from a config file.
+
+        Without configs, every map config in config_dir is watched, including
+        configs added while watching. settings are set as attributes of every
+        generator (e.g. force).
+        """
+        self.generator_factory = generator_factory
+        self.configs = None if configs is None else [Path(config) for config in configs]
+        self.settings = settings or {}
+        self.config_dir = Path(config_dir)
+        self.maps = {}
+        self.scanned = None
+        self.found = []
+
+    def config_files(self):
+        """Get the configs to watch, rescanning the config directory when its files change."""
+        if self.configs is not None:
+            return self.configs
+
+        paths = sorted(self.config_dir.glob('*.yaml'))
+        if paths != self.scanned:
+            self.scanned = paths
+            self.found = map_configs(paths, skip_tests=True)
+
+        return self.found
+
+    def fingerprint(self, watched):
+        """Get the current fingerprint of a map, reloading its config if the file changed.
+
+        Returns None while the config cannot be loaded; the map then keeps
+        its last rendered output until the config is fixed.
+        """
+        mtime = watched.config_file.stat().st_mtime_ns
+
+        if mtime != watched.config_mtime:
+            watched.config_mtime = mtime
+            try:
+                if watched.generator is None:
+                    watched.generator = self.generator_factory(watched.config_file)
+                    watched.generator.keep_rasters = True
+                    for name, value in self.settings.items():
+                        setattr(watched.generator, name, value)
+                else:
+                    watched.generator.reload_config()
+                watched.broken = False
+            except Exception as e:
+                logger.error(f"{watched.config_file}: cannot load config: {describe_error(e)}")
+                watched.broken = True
+
+        if watched.broken:
+            return None
+
+        return watched.generator.fingerprint()
+
+    def poll(self):
+        """Check every map once, re-rendering those whose inputs changed and then settled.
+
+        Returns the number of maps rendered.
+        """
+        files = self.config_files()
+        for config_file in list(self.maps):
+            if config_file not in files:
+                logger.info(f"No longer watching {config_file}")
+                del self.maps[config_file]
+
+        due = []
+        now = time.monotonic()
+        for config_file in files:
+            watched = self.maps.setdefault(config_file, WatchedMap(config_file))
+
+            try:
+                fingerprint = self.fingerprint(watched)
+            except OSError:
+                # Editors may replace a file by deleting and recreating it
+                continue
+            except Exception as e:
+                # A config that loads but cannot be used waits for the next edit
+                logger.error(f"{config_file}: {describe_error(e)}")
+                watched.broken = True
+                fingerprint = None
+
+            if fingerprint is None or fingerprint == watched.rendered:
+                watched.pending = None
+            elif fingerprint != watched.pending:
+                watched.pending, watched.pending_since = fingerprint, now
+            elif now - watched.pending_since >= DEBOUNCE:
+                due.append(watched)
+
+        for watched in due:
+            self.render(watched)
+
+        if due:
+            try:
+                # Maps are encoded in the background
+                ENCODER.wait()
+            except Exception as e:
+                logger.error(f"Could not save a map: {describe_error(e)}")
+
+        return len(due)
+
+    def render(self, watched):
+        """Render a map whose inputs changed.
+
+        The map counts as rendered from its pending inputs even if rendering
+        fails, so a broken map is retried when its inputs change again.
+        """
+        start = time.perf_counter()
+
+        try:
+            status = 'rendered' if watched.generator.generate() else 'up to date'
+            if status == 'rendered' and watched.generator.failures:
+                logger.warning(
+                    f"{watched.config_file}: degraded in {time.perf_counter() - start:.2f}s: "
+                    f"{'; '.join(watched.generator.failures)}"
+                )
+            else:
+                logger.info(f"{watched.config_file}: {status} in {time.perf_counter() - start:.2f}s")
+        except Exception as e:
+            logger.error(f"{watched.config_file}: failed after {time.perf_counter() - start:.2f}s: {describe_error(e)}")
+
+        watched.rendered, watched.pending = watched.pending, None
+
+    def run(self):
+        """Watch until interrupted."""
+        logger.info(f"Watching {len(self.config_files())} maps for changes (Ctrl+C to stop)")
+
+        try:
+            while True:
+                self.poll()
+                time.sleep(POLL_INTERVAL)
+        except KeyboardInterrupt:
+            logger.info("Stopped watching")
+        finally:
+            ENCODER.wait()
+
+def watch(generator_factory, configs=None, settings=None, config_dir=CONFIG_DIR):
+    """Watch map configs and their inputs, re-rendering maps as they change, until interrupted."""
+    MapWatcher(generator_factory, configs, settings, config_dir).run()
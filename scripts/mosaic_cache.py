@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+"""
+Basemap mosaic cache for Wall TV Maps project.
+Keeps each assembled basemap mosaic, at tile resolution, with its Web
+Mercator extent, so maps over the same area reuse it instead of decoding
+and stitching the same tiles again.
+"""
+
+import os
+import json
+import hashlib
+import logging
+import threading
+import numpy as np
+
+from file_cache import MOSAIC_FILES
+
+logger = logging.getLogger(__name__)
+
+MOSAIC_CACHE_DIR = MOSAIC_FILES.directory
+
+# Bump when the way mosaics are assembled changes, to invalidate old entries
+MOSAIC_CACHE_VERSION = 1
+
+def mosaic_cache_key(**parts):
+    """Compute the cache key of a mosaic from its source, zoom and tile block."""
+    key = dict(parts, version=MOSAIC_CACHE_VERSION)
+    return hashlib.sha1(json.dumps(key, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+def mosaic_paths(key):
+    """Get the paths of a cached mosaic's array and extent."""
+    return MOSAIC_CACHE_DIR / f"{key}.npy", MOSAIC_CACHE_DIR / f"{key}.json"
+
+def load_cached_mosaic(key):
+    """Load a cached mosaic as (rgba, extent), or None if not cached.
+
+    The array is memory-mapped, so only the part a map shows is read from disk.
+    """
+    array_path, extent_path = mosaic_paths(key)
+    if not extent_path.exists():
+        return None
+
+    try:
+        info = json.loads(extent_path.read_text(encoding='utf-8'))
+        rgba = np.load(array_path, mmap_mode='r', allow_pickle=False)
+        if list(rgba.shape) != info['shape'] or rgba.dtype != np.uint8:
+            return None
+        MOSAIC_FILES.used(extent_path)
+        return rgba, tuple(info['extent'])
+    except Exception as e:
+        logger.warning(f"Ignoring unreadable mosaic cache entry {array_path}: {e}")
+        return None
+
+def store_cached_mosaic(key, rgba, extent):
+    """Store an assembled mosaic and its (left, right, bottom, top) extent in the cache."""
+    array_path, extent_path = mosaic_paths(key)
+    suffix = f".{os.getpid()}.{threading.get_ident()}.tmp"
+    tmp_paths = [path.with_name(path.name + suffix) for path in (array_path, extent_path)]
+
+    try:
+        MOSAIC_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        with open(tmp_paths[0], 'wb') as f:
+            np.save(f, rgba, allow_pickle=False)
+        tmp_paths[1].write_text(json.dumps({'extent': list(extent), 'shape': list(rgba.shape)}), encoding='utf-8')
+
+        # The extent goes last: a mosaic only counts as cached once it exists
+        os.replace(tmp_paths[0], array_path)
+        os.replace(tmp_paths[1], extent_path)
+        MOSAIC_FILES.added(array_path, extent_path)
+    except Exception as e:
+        logger.warning(f"Could not cache mosaic in {array_path}: {e}")
+    finally:
+        for tmp_path in tmp_paths:
+            if tmp_path.exists():
+                tmp_path.unlink()
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+"""
+Pack basemap tiles for Wall TV Maps project.
+Writes the tiles of one provider from the basemap cache in data/cache into
+an MBTiles or PMTiles archive, which maps can then use as an offline
+basemap source.
+"""
+
+import sys
+import time
+import logging
+from pathlib import Path
+import click
+
+from tile_store import TILES
+from tile_archives import write_mbtiles, write_pmtiles
+from utils import get_file_size_mb
+
+# Setup logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+WRITERS = {'.mbtiles': write_mbtiles, '.pmtiles': write_pmtiles}
+
+@click.command()
+@click.option('--provider', '-p', help='Provider to pack (e.g. OpenTopoMap); needed when several are cached')
+@click.option('--min-zoom', type=int, help='Lowest zoom level to include')
+@click.option('--max-zoom', type=int, help='Highest zoom level to include')
+@click.option('--name', help='Tileset name stored in the archive (defaults to the provider)')
+@click.option('--attribution', default='', help='Attribution text stored in the archive')
+@click.argument('output', type=click.Path(path_type=Path))
+def main(provider, min_zoom, max_zoom, name, attribution, output):
+    """Pack cached basemap tiles into an .mbtiles or .pmtiles archive."""
+
+    writer = WRITERS.get(output.suffix.lower())
+    if writer is None:
+        logger.error(f"Output must end in {' or '.join(WRITERS)}: {output}")
+        sys.exit(1)
+
+    providers = TILES.providers(provider)
+    if not providers:
+        logger.error("No cached tiles" + (f" for {provider}" if provider else ""))
+        sys.exit(1)
+
+    if len(providers) > 1:
+        logger.error(f"Several cached providers match, pick one with --provider: {', '.join(providers)}")
+        sys.exit(1)
+
+    slug = providers[0]
+    keys = TILES.tile_keys(slug, min_zoom, max_zoom)
+    if not keys:
+        logger.error(f"No cached tiles for {slug} in the requested zoom range")
+        sys.exit(1)
+
+    start = time.perf_counter()
+    output.parent.mkdir(parents=True, exist_ok=True)
+    written = writer(
+        output,
+        keys,
+        lambda ordered: TILES.iter_tiles(slug, ordered),
+        name=name or slug.rsplit('-', 1)[0],
+        attribution=attribution,
+    )
+
+    zooms = sorted({z for z, _, _ in keys})
+    logger.info(
+        f"Packed {written} tiles of {slug} (zoom {zooms[0]}-{zooms[-1]}) into {output} "
+        f"({get_file_size_mb(output):.1f} MB) in {time.perf_counter() - start:.1f}s"
+    )
+
+if __name__ == "__main__":
+    main()
@@ -13,6 +13,8 @@ import pandas as pd
 from shapely.geometry import Point, Polygon
 import click
 
+from utils import save_geodata
+
 # Setup logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
@@ -64,7 +66,7 @@ def process_spanish_regions():
 
     # Save processed data
     output_path = PROCESSED_DIR / "spain_regions.geojson"
-    spain_regions.to_file(output_path, driver='GeoJSON')
+    save_geodata(spain_regions, output_path)
     logger.info(f"Processed Spanish regions saved to: {output_path}")
 
 def process_spanish_provinces():
@@ -110,7 +112,7 @@ def process_asturias_detailed():
 
     # Save
     output_path = PROCESSED_DIR / "asturias_municipalities.geojson"
-    gdf.to_file(output_path, driver='GeoJSON')
+    save_geodata(gdf, output_path)
     logger.info(f"Processed Asturias municipalities saved to: {output_path}")
 
 def process_gijon_detailed():
@@ -146,7 +148,7 @@ def process_gijon_detailed():
 
     # Save
     output_path = PROCESSED_DIR / "gijon_districts.geojson"
-    gdf.to_file(output_path, driver='GeoJSON')
+    save_geodata(gdf, output_path)
     logger.info(f"Processed Gijón districts saved to: {output_path}")
 
 def create_placeholder_files():
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+"""
+Per-layer raster cache for Wall TV Maps project.
+Keeps each rendered layer as an RGBA image at the output resolution, so a
+map can be rebuilt by compositing cached layers and only redrawing those
+whose data, style or extent changed.
+"""
+
+import os
+import json
+import hashlib
+import logging
+import threading
+import numpy as np
+from PIL import Image
+
+from file_cache import RASTER_FILES
+
+logger = logging.getLogger(__name__)
+
+RASTER_CACHE_DIR = RASTER_FILES.directory
+
+# Bump when the way layers are drawn changes, to invalidate old entries
+RASTER_CACHE_VERSION = 1
+
+def raster_cache_key(**parts):
+    """Compute the cache key of a raster from everything that affects its pixels."""
+    key = dict(parts, version=RASTER_CACHE_VERSION)
+    return hashlib.sha1(json.dumps(key, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+def raster_path(key):
+    """Get the path of a cached raster.
+
+    Rasters are stored as raw arrays rather than PNG: they are larger on
+    disk, but load in milliseconds instead of having to be decoded.
+    """
+    return RASTER_CACHE_DIR / f"{key}.npy"
+
+def load_cached_raster(key, size):
+    """Load a cached RGBA raster as a (height, width, 4) array, or None if not cached."""
+    path = raster_path(key)
+    if not path.exists():
+        return None
+
+    width, height = size
+
+    try:
+        rgba = np.load(path, allow_pickle=False)
+        if rgba.shape != (height, width, 4) or rgba.dtype != np.uint8:
+            return None
+        RASTER_FILES.used(path)
+        return rgba
+    except Exception as e:
+        logger.warning(f"Ignoring unreadable raster cache entry {path}: {e}")
+        return None
+
+def store_cached_raster(key, rgba):
+    """Store a rendered RGBA raster in the cache."""
+    path = raster_path(key)
+    tmp_path = path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+
+    try:
+        RASTER_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        with open(tmp_path, 'wb') as f:
+            np.save(f, rgba, allow_pickle=False)
+        # Atomic rename so concurrent renders never see a partial file
+        os.replace(tmp_path, path)
+        RASTER_FILES.added(path)
+    except Exception as e:
+        logger.warning(f"Could not cache raster in {path}: {e}")
+    finally:
+        if tmp_path.exists():
+            tmp_path.unlink()
+
+def composite(background, rasters):
+    """Alpha-composite RGBA rasters over a background image, in the given order."""
+    image = background.convert('RGBA')
+
+    for rgba in rasters:
+        image.alpha_composite(Image.fromarray(rgba, 'RGBA'))
+
+    return image
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+"""
+Staged rendering for Wall TV Maps project.
+Runs the steps of a map render as stages with explicit dependencies, each
+starting as soon as the stages it needs have finished, so network-bound
+basemap fetching overlaps disk and CPU-bound layer loading. Records when
+each stage ran, so the overlap can be seen.
+"""
+
+import time
+import logging
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+# A step of a render: its name, a callable taking no arguments, and the
+# names of the stages that must finish before it starts
+Stage = namedtuple('Stage', ['name', 'run', 'needs'])
+
+def run_stages(stages):
+    """Run stages as soon as their dependencies allow.
+
+    Stages must be listed after the stages they need. Returns the
+    (start, end) of every stage in seconds since the first one started.
+    If stages fail, the first failure in stage order is raised once all
+    stages are done; stages needing a failed one fail with its error.
+    """
+    timings = {}
+    futures = {}
+    origin = time.perf_counter()
+
+    def run(stage):
+        for need in stage.needs:
+            futures[need].result()
+
+        start = time.perf_counter() - origin
+        try:
+            stage.run()
+        finally:
+            timings[stage.name] = (start, time.perf_counter() - origin)
+
+    # One thread per stage, so stages waiting on others never starve them
+    with ThreadPoolExecutor(max_workers=len(stages), thread_name_prefix='stage') as pool:
+        for stage in stages:
+            missing = [need for need in stage.needs if need not in futures]
+            if missing:
+                raise ValueError(f"Stage {stage.name} needs {missing}, which must be listed before it")
+            futures[stage.name] = pool.submit(run, stage)
+
+    for stage in stages:
+        error = futures[stage.name].exception()
+        if error is not None:
+            raise error
+
+    return timings
+
+def describe_timings(timings):
+    """Summarize stage timings: when each stage ran, and how much of it overlapped."""
+    wall = max(end for _, end in timings.values()) - min(start for start, _ in timings.values())
+    busy = sum(end - start for start, end in timings.values())
+
+    stages = ", ".join(f"{name} {start:.2f}-{end:.2f}s" for name, (start, end) in timings.items())
+    return f"{stages}; {wall:.2f}s wall for {busy:.2f}s of stages ({max(busy - wall, 0):.2f}s overlapped)"
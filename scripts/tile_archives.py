@@ -0,0 +1,460 @@
+#!/usr/bin/env python3
+"""
+Offline basemap tile archives for Wall TV Maps project.
+Reads raster tiles straight from MBTiles (SQLite) and PMTiles v3 archives,
+fetching all tiles of a map's range at once, and writes such archives so
+tiles downloaded once can be rendered on hosts without network access.
+"""
+
+import os
+import gzip
+import mmap
+import json
+import math
+import struct
+import sqlite3
+import logging
+import hashlib
+import threading
+from bisect import bisect_right
+from pathlib import Path
+from contextlib import closing
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_SUFFIXES = ('.mbtiles', '.pmtiles')
+
+# PMTiles v3 header: magic, version, 11 offsets/lengths/counts, 6 flags and
+# zooms, bounds and center as 1e7 fixed point degrees
+PMTILES_HEADER = struct.Struct('<7sB11Q6B4iB2i')
+PMTILES_MAGIC = b'PMTiles'
+
+# PMTiles compression and tile type codes
+COMPRESSION_NONE = 1
+COMPRESSION_GZIP = 2
+PMTILES_TILE_TYPES = {'mvt': 1, 'png': 2, 'jpeg': 3, 'webp': 4, 'avif': 5}
+
+# Readers must find the header and root directory in the first 16 KB
+PMTILES_ROOT_SIZE = 16384
+
+# Entries per leaf directory to start with when the root would be too big
+PMTILES_LEAF_SIZE = 4096
+
+def is_archive(source):
+    """Check whether a basemap source names a local tile archive."""
+    return isinstance(source, (str, Path)) and str(source).lower().endswith(ARCHIVE_SUFFIXES)
+
+def archive_signature(source):
+    """Get what identifies the current contents of an archive: path, mtime and size."""
+    path = Path(source)
+    if not path.exists():
+        return [str(path), None]
+    stat = path.stat()
+    return [str(path), stat.st_mtime_ns, stat.st_size]
+
+def tile_format(data):
+    """Detect the image format of a tile from its first bytes."""
+    if data.startswith(b'\x89PNG'):
+        return 'png'
+    if data.startswith(b'\xff\xd8'):
+        return 'jpeg'
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'webp'
+    return None
+
+def tile_bounds(z, x, y):
+    """Get the (west, south, east, north) bounds of a tile in degrees."""
+    n = 2 ** z
+
+    def latitude(row):
+        return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * row / n))))
+
+    return x / n * 360 - 180, latitude(y + 1), (x + 1) / n * 360 - 180, latitude(y)
+
+def zxy_to_tile_id(z, x, y):
+    """Get the PMTiles tile ID of a tile: its position along the zoom's Hilbert curve."""
+    tile_id = ((1 << (2 * z)) - 1) // 3
+    s = 1 << z >> 1
+    while s > 0:
+        rx = 1 if x & s else 0
+        ry = 1 if y & s else 0
+        tile_id += s * s * ((3 * rx) ^ ry)
+        if ry == 0:
+            if rx == 1:
+                x = s - 1 - x
+                y = s - 1 - y
+            x, y = y, x
+        s >>= 1
+    return tile_id
+
+def write_varint(buffer, value):
+    """Append an unsigned LEB128 varint to a bytearray."""
+    while value >= 0x80:
+        buffer.append((value & 0x7f) | 0x80)
+        value >>= 7
+    buffer.append(value)
+
+def read_varint(data, position):
+    """Read an unsigned LEB128 varint, returning (value, next position)."""
+    value = shift = 0
+    while True:
+        byte = data[position]
+        position += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, position
+        shift += 7
+
+def serialize_directory(entries):
+    """Encode PMTiles directory entries (tile_id, offset, length, run_length), gzipped."""
+    buffer = bytearray()
+    write_varint(buffer, len(entries))
+
+    last_id = 0
+    for tile_id, _, _, _ in entries:
+        write_varint(buffer, tile_id - last_id)
+        last_id = tile_id
+    for _, _, _, run_length in entries:
+        write_varint(buffer, run_length)
+    for _, _, length, _ in entries:
+        write_varint(buffer, length)
+
+    for i, (_, offset, _, _) in enumerate(entries):
+        # 0 means "right after the previous entry's data"
+        if i > 0 and offset == entries[i - 1][1] + entries[i - 1][2]:
+            write_varint(buffer, 0)
+        else:
+            write_varint(buffer, offset + 1)
+
+    return gzip.compress(bytes(buffer), mtime=0)
+
+def deserialize_directory(data, compression):
+    """Decode a PMTiles directory into parallel lists (tile_ids, offsets, lengths, run_lengths)."""
+    if compression == COMPRESSION_GZIP:
+        data = gzip.decompress(data)
+    elif compression != COMPRESSION_NONE:
+        raise ValueError(f"Unsupported PMTiles directory compression {compression}")
+
+    count, position = read_varint(data, 0)
+    columns = [[0] * count for _ in range(4)]
+    tile_ids, offsets, lengths, run_lengths = columns
+
+    tile_id = 0
+    for i in range(count):
+        delta, position = read_varint(data, position)
+        tile_id += delta
+        tile_ids[i] = tile_id
+    for column in (run_lengths, lengths):
+        for i in range(count):
+            column[i], position = read_varint(data, position)
+    for i in range(count):
+        value, position = read_varint(data, position)
+        offsets[i] = offsets[i - 1] + lengths[i - 1] if value == 0 and i > 0 else value - 1
+
+    return tile_ids, offsets, lengths, run_lengths
+
+class MBTilesArchive:
+    """Read-only MBTiles archive."""
+
+    def __init__(self, path):
+        """Open an archive and read its metadata."""
+        self.path = Path(path)
+        self.local = threading.local()
+
+        connection = self.connection()
+        self.metadata = dict(connection.execute("SELECT name, value FROM metadata"))
+        if self.metadata.get('format') == 'pbf':
+            raise ValueError(f"{self.path} holds vector tiles; only raster basemaps are supported")
+
+        min_zoom, max_zoom = connection.execute("SELECT MIN(zoom_level), MAX(zoom_level) FROM tiles").fetchone()
+        self.min_zoom = int(self.metadata.get('minzoom', min_zoom or 0))
+        self.max_zoom = int(self.metadata.get('maxzoom', max_zoom or 0))
+        self.name = self.metadata.get('name', self.path.stem)
+
+    def connection(self):
+        """Get this thread's read-only connection."""
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(f"{self.path.resolve().as_uri()}?mode=ro", uri=True)
+            self.local.connection = connection
+        return connection
+
+    def read_tiles(self, zoom, xs, ys):
+        """Read every stored tile of a block with one query, as {(z, x, y): bytes}."""
+        # MBTiles rows count from the bottom (TMS), XYZ rows from the top
+        flip = 2 ** zoom - 1
+        rows = self.connection().execute(
+            """SELECT tile_column, tile_row, tile_data FROM tiles
+               WHERE zoom_level = ? AND tile_column BETWEEN ? AND ? AND tile_row BETWEEN ? AND ?""",
+            (zoom, xs.start, xs.stop - 1, flip - (ys.stop - 1), flip - ys.start)
+        )
+        return {(zoom, x, flip - row): data for x, row, data in rows}
+
+class PMTilesArchive:
+    """Read-only PMTiles v3 archive, memory-mapped."""
+
+    def __init__(self, path):
+        """Open an archive and read its header."""
+        self.path = Path(path)
+
+        with open(self.path, 'rb') as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        fields = PMTILES_HEADER.unpack_from(self.data, 0)
+        magic, version = fields[:2]
+        if magic != PMTILES_MAGIC or version != 3:
+            raise ValueError(f"{self.path} is not a PMTiles v3 archive")
+
+        (self.root_offset, self.root_length, metadata_offset, metadata_length,
+         self.leaves_offset, _, self.tiles_offset, _, _, _, _,
+         _, self.internal_compression, self.tile_compression, tile_type,
+         self.min_zoom, self.max_zoom) = fields[2:19]
+
+        if tile_type == PMTILES_TILE_TYPES['mvt']:
+            raise ValueError(f"{self.path} holds vector tiles; only raster basemaps are supported")
+
+        metadata = bytes(self.data[metadata_offset:metadata_offset + metadata_length])
+        if metadata and self.internal_compression == COMPRESSION_GZIP:
+            metadata = gzip.decompress(metadata)
+        self.metadata = json.loads(metadata) if metadata else {}
+        self.name = self.metadata.get('name', self.path.stem)
+
+        # Decoded directories by offset; the root plus the few leaves a map touches
+        self.directories = {}
+        self.lock = threading.Lock()
+
+    def directory(self, offset, length):
+        """Get a decoded directory, decoding it on first use."""
+        with self.lock:
+            directory = self.directories.get(offset)
+        if directory is None:
+            directory = deserialize_directory(self.data[offset:offset + length], self.internal_compression)
+            with self.lock:
+                self.directories[offset] = directory
+        return directory
+
+    def locate(self, tile_id):
+        """Get the (offset, length) of a tile's data, or None if the archive lacks it."""
+        offset, length = self.root_offset, self.root_length
+
+        # The root can point to leaves, which in principle can point to further leaves
+        for _ in range(4):
+            tile_ids, offsets, lengths, run_lengths = self.directory(offset, length)
+            i = bisect_right(tile_ids, tile_id) - 1
+            if i < 0:
+                return None
+
+            if run_lengths[i] == 0:
+                offset, length = self.leaves_offset + offsets[i], lengths[i]
+            elif tile_id - tile_ids[i] < run_lengths[i]:
+                return self.tiles_offset + offsets[i], lengths[i]
+            else:
+                return None
+
+        return None
+
+    def read_tiles(self, zoom, xs, ys):
+        """Read every stored tile of a block, as {(z, x, y): bytes}.
+
+        Tiles are located through the cached directories in tile ID order,
+        then sliced from the memory map without further file reads.
+        """
+        tiles = sorted((zxy_to_tile_id(zoom, x, y), x, y) for y in ys for x in xs)
+
+        found = {}
+        for tile_id, x, y in tiles:
+            location = self.locate(tile_id)
+            if location is None:
+                continue
+
+            offset, length = location
+            data = self.data[offset:offset + length]
+            if self.tile_compression == COMPRESSION_GZIP:
+                data = gzip.decompress(data)
+            found[(zoom, x, y)] = data
+
+        return found
+
+# Open archives by path, reopened when the file changes
+ARCHIVES = {}
+ARCHIVES_LOCK = threading.Lock()
+
+def open_archive(source):
+    """Get an open archive for a .mbtiles or .pmtiles path."""
+    path = Path(source)
+    if not path.exists():
+        raise FileNotFoundError(f"Basemap archive not found: {path}")
+
+    signature = archive_signature(path)
+    with ARCHIVES_LOCK:
+        cached = ARCHIVES.get(str(path))
+        if cached is not None and cached[0] == signature:
+            return cached[1]
+
+        archive_class = MBTilesArchive if path.suffix.lower() == '.mbtiles' else PMTilesArchive
+        archive = archive_class(path)
+        ARCHIVES[str(path)] = (signature, archive)
+        return archive
+
+def archive_bounds(keys):
+    """Get the (west, south, east, north) bounds of a set of (z, x, y) tiles, in degrees."""
+    max_zoom = max(z for z, _, _ in keys)
+    bounds = [tile_bounds(z, x, y) for z, x, y in keys if z == max_zoom]
+    return (
+        min(b[0] for b in bounds), min(b[1] for b in bounds),
+        max(b[2] for b in bounds), max(b[3] for b in bounds),
+    )
+
+def write_mbtiles(path, keys, read_tiles, name, attribution=''):
+    """Write tiles to an MBTiles archive.
+
+    keys are the (z, x, y) tiles to write and read_tiles(keys) yields
+    (z, x, y, bytes) for them. Returns the number of tiles written.
+    """
+    path = Path(path)
+    tmp_path = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+    if tmp_path.exists():
+        tmp_path.unlink()
+
+    written = 0
+    image_format = None
+
+    try:
+        with closing(sqlite3.connect(tmp_path)) as connection:
+            connection.executescript("""
+                CREATE TABLE metadata (name TEXT, value TEXT);
+                CREATE TABLE tiles (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_data BLOB);
+                CREATE UNIQUE INDEX tile_index ON tiles (zoom_level, tile_column, tile_row);
+            """)
+
+            with connection:
+                for z, x, y, data in read_tiles(keys):
+                    image_format = image_format or tile_format(data)
+                    connection.execute(
+                        "INSERT INTO tiles VALUES (?, ?, ?, ?)",
+                        (z, x, 2 ** z - 1 - y, data)
+                    )
+                    written += 1
+
+                west, south, east, north = archive_bounds(keys)
+                min_zoom = min(z for z, _, _ in keys)
+                metadata = {
+                    'name': name,
+                    'type': 'baselayer',
+                    'version': '1.0',
+                    'format': image_format or 'png',
+                    'minzoom': min_zoom,
+                    'maxzoom': max(z for z, _, _ in keys),
+                    'bounds': f"{west:.6f},{south:.6f},{east:.6f},{north:.6f}",
+                    'center': f"{(west + east) / 2:.6f},{(south + north) / 2:.6f},{min_zoom}",
+                    'attribution': attribution,
+                }
+                connection.executemany("INSERT INTO metadata VALUES (?, ?)", [(k, str(v)) for k, v in metadata.items()])
+
+        os.replace(tmp_path, path)
+    finally:
+        if tmp_path.exists():
+            tmp_path.unlink()
+
+    return written
+
+def pmtiles_directories(entries):
+    """Split directory entries into a root directory and leaf directories that fit the header block."""
+    root = serialize_directory(entries)
+    if PMTILES_HEADER.size + len(root) <= PMTILES_ROOT_SIZE:
+        return root, b''
+
+    leaf_size = PMTILES_LEAF_SIZE
+    while True:
+        leaves = bytearray()
+        root_entries = []
+        for start in range(0, len(entries), leaf_size):
+            leaf = serialize_directory(entries[start:start + leaf_size])
+            root_entries.append((entries[start][0], len(leaves), len(leaf), 0))
+            leaves += leaf
+
+        root = serialize_directory(root_entries)
+        if PMTILES_HEADER.size + len(root) <= PMTILES_ROOT_SIZE:
+            return root, bytes(leaves)
+        leaf_size *= 2
+
+def write_pmtiles(path, keys, read_tiles, name, attribution=''):
+    """Write tiles to a PMTiles v3 archive.
+
+    keys are the (z, x, y) tiles to write and read_tiles(keys) yields
+    (z, x, y, bytes) for them in the given order. Identical tiles (open
+    sea, say) are stored once. Returns the number of tiles written.
+    """
+    path = Path(path)
+    tmp_path = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+    data_path = path.with_name(f".{path.name}.{os.getpid()}.data.tmp")
+
+    # Tile data must be laid out in tile ID order
+    ordered = sorted(keys, key=lambda key: zxy_to_tile_id(*key))
+
+    entries = []
+    contents = {}
+    image_format = None
+    data_length = 0
+
+    try:
+        with open(data_path, 'wb') as data_file:
+            for z, x, y, data in read_tiles(ordered):
+                image_format = image_format or tile_format(data)
+                tile_id = zxy_to_tile_id(z, x, y)
+
+                digest = hashlib.sha1(data).digest()
+                content = contents.get(digest)
+                if content is None:
+                    content = contents[digest] = (data_length, len(data))
+                    data_file.write(data)
+                    data_length += len(data)
+
+                last = entries[-1] if entries else None
+                if last and last[1:3] == content and last[0] + last[3] == tile_id:
+                    # Same content as the tile before: extend its run
+                    entries[-1] = (last[0], last[1], last[2], last[3] + 1)
+                else:
+                    entries.append((tile_id, *content, 1))
+
+        root, leaves = pmtiles_directories(entries)
+
+        west, south, east, north = archive_bounds(keys)
+        metadata = gzip.compress(json.dumps({
+            'name': name,
+            'type': 'baselayer',
+            'attribution': attribution,
+        }).encode('utf-8'), mtime=0)
+
+        root_offset = PMTILES_HEADER.size
+        metadata_offset = root_offset + len(root)
+        leaves_offset = metadata_offset + len(metadata)
+        tiles_offset = leaves_offset + len(leaves)
+        min_zoom = min(z for z, _, _ in keys)
+
+        header = PMTILES_HEADER.pack(
+            PMTILES_MAGIC, 3,
+            root_offset, len(root),
+            metadata_offset, len(metadata),
+            leaves_offset, len(leaves),
+            tiles_offset, data_length,
+            sum(entry[3] for entry in entries), len(entries), len(contents),
+            1, COMPRESSION_GZIP, COMPRESSION_NONE, PMTILES_TILE_TYPES.get(image_format, 0),
+            min_zoom, max(z for z, _, _ in keys),
+            round(west * 1e7), round(south * 1e7), round(east * 1e7), round(north * 1e7),
+            min_zoom, round((west + east) / 2 * 1e7), round((south + north) / 2 * 1e7),
+        )
+
+        with open(tmp_path, 'wb') as f:
+            f.write(header + root + metadata + leaves)
+            with open(data_path, 'rb') as data_file:
+                while chunk := data_file.read(1024 * 1024):
+                    f.write(chunk)
+
+        os.replace(tmp_path, path)
+    finally:
+        for leftover in (tmp_path, data_path):
+            if leftover.exists():
+                leftover.unlink()
+
+    return len(ordered)
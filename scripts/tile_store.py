@@ -0,0 +1,333 @@
+#!/usr/bin/env python3
+"""
+Basemap tile store for Wall TV Maps project.
+Keeps downloaded tiles in one SQLite database indexed by provider, zoom,
+column and row, with each tile's size and last access time. The store is
+bounded in size by evicting the least recently used tiles, can be cleared
+per provider, and can be shared by several render processes at once.
+"""
+
+import os
+import time
+import shutil
+import sqlite3
+import logging
+import threading
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+TILE_DB = Path("data/cache/tiles.sqlite")
+
+# Where contextily cached tiles before the tile store replaced it
+LEGACY_TILE_DIR = Path("data/cache/contextily")
+
+# Size the store is kept under unless another limit has been saved in it
+DEFAULT_MAX_MB = 1024
+
+# Eviction frees space down to this fraction of the limit, so it runs rarely
+EVICTION_TARGET = 0.9
+
+# How long to wait for another process holding the write lock, in seconds
+BUSY_TIMEOUT = 30
+
+# Tiles a server does not have are stored empty, so they are not requested
+# again until this many seconds have passed
+ABSENT_TILE_TTL = 7 * 24 * 3600
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tiles (
+    provider TEXT NOT NULL,
+    z INTEGER NOT NULL,
+    x INTEGER NOT NULL,
+    y INTEGER NOT NULL,
+    data BLOB NOT NULL,
+    size INTEGER NOT NULL,
+    last_access REAL NOT NULL,
+    PRIMARY KEY (provider, z, x, y)
+);
+CREATE INDEX IF NOT EXISTS tiles_last_access ON tiles (last_access);
+
+-- Running totals, so checking the store size never scans the tiles
+CREATE TABLE IF NOT EXISTS totals (
+    id INTEGER PRIMARY KEY CHECK (id = 0),
+    tiles INTEGER NOT NULL,
+    bytes INTEGER NOT NULL,
+    max_bytes INTEGER
+);
+INSERT OR IGNORE INTO totals VALUES (0, 0, 0, NULL);
+
+CREATE TRIGGER IF NOT EXISTS tiles_insert AFTER INSERT ON tiles BEGIN
+    UPDATE totals SET tiles = tiles + 1, bytes = bytes + NEW.size;
+END;
+CREATE TRIGGER IF NOT EXISTS tiles_delete AFTER DELETE ON tiles BEGIN
+    UPDATE totals SET tiles = tiles - 1, bytes = bytes - OLD.size;
+END;
+CREATE TRIGGER IF NOT EXISTS tiles_resize AFTER UPDATE OF size ON tiles BEGIN
+    UPDATE totals SET bytes = bytes - OLD.size + NEW.size;
+END;
+"""
+
+# A provider name matches itself, and any provider it is the group or name part of
+PROVIDER_MATCH = "provider = ? OR provider GLOB ? OR provider GLOB ?"
+
+def provider_patterns(provider):
+    """Get the parameters of PROVIDER_MATCH for a provider name."""
+    return provider, f"{provider}.*", f"{provider}-*"
+
+class TileStore:
+    """SQLite store of downloaded tiles with LRU eviction to a size limit.
+
+    Providers are identified by a string such as basemap_tiles.provider_slug.
+    Tiles the provider does not have are stored with empty data (see
+    put_absent) and count as stored until ABSENT_TILE_TTL has passed.
+    Each thread (and each process after a fork) gets its own connection; the
+    database runs in WAL mode, so readers never wait for writers and writers
+    from different processes queue up on SQLite's lock.
+    """
+
+    def __init__(self, db_path=TILE_DB, max_bytes=None):
+        """Initialize with the database file and an optional size limit in bytes.
+
+        Without a limit, the one saved in the database is used, or
+        DEFAULT_MAX_MB if none was saved.
+        """
+        self.db_path = Path(db_path)
+        self.max_bytes = max_bytes
+        self.local = threading.local()
+
+    def connection(self):
+        """Get this thread's connection, opening the database on first use."""
+        connection = getattr(self.local, 'connection', None)
+        if connection is not None and self.local.pid == os.getpid():
+            return connection
+
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        # Autocommit mode; writes open their own transactions
+        connection = sqlite3.connect(self.db_path, timeout=BUSY_TIMEOUT, isolation_level=None)
+        connection.execute(f"PRAGMA busy_timeout = {BUSY_TIMEOUT * 1000}")
+        # Must be set before the tables exist; lets deleted space be given back
+        connection.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        connection.execute("PRAGMA journal_mode = WAL")
+        connection.execute("PRAGMA synchronous = NORMAL")
+
+        # In one transaction, so processes opening a new database together agree on it
+        connection.executescript(f"BEGIN IMMEDIATE; {SCHEMA} COMMIT;")
+
+        self.local.connection = connection
+        self.local.pid = os.getpid()
+        return connection
+
+    def transaction(self, connection=None):
+        """Get a context manager running a write transaction."""
+        return Transaction(connection or self.connection())
+
+    def limit(self):
+        """Get the size limit in bytes."""
+        if self.max_bytes is not None:
+            return self.max_bytes
+
+        row = self.connection().execute("SELECT max_bytes FROM totals").fetchone()
+        return row[0] if row[0] is not None else DEFAULT_MAX_MB * 1024 * 1024
+
+    def set_limit(self, max_bytes):
+        """Save a size limit in the database, for every process using it, and apply it."""
+        with self.transaction() as connection:
+            connection.execute("UPDATE totals SET max_bytes = ?", (max_bytes,))
+        self.evict()
+
+    def missing(self, provider, tiles):
+        """Get the (z, x, y) tiles of the list that are not stored, or were absent too long ago."""
+        connection = self.connection()
+        query = (
+            "SELECT 1 FROM tiles WHERE provider = ? AND z = ? AND x = ? AND y = ? "
+            "AND (size > 0 OR last_access >= ?)"
+        )
+        expired = time.time() - ABSENT_TILE_TTL
+        return [tile for tile in tiles if connection.execute(query, (provider, *tile, expired)).fetchone() is None]
+
+    def get_many(self, provider, tiles):
+        """Get stored tiles as {(z, x, y): bytes}, marking them as recently used.
+
+        Tiles that are not stored, or that the provider does not have, are
+        left out. The latter keep the time they were found absent, so they
+        expire.
+        """
+        connection = self.connection()
+        query = "SELECT data FROM tiles WHERE provider = ? AND z = ? AND x = ? AND y = ? AND size > 0"
+
+        found = {}
+        for tile in tiles:
+            row = connection.execute(query, (provider, *tile)).fetchone()
+            if row is not None:
+                found[tile] = row[0]
+
+        now = time.time()
+        try:
+            with self.transaction(connection):
+                connection.executemany(
+                    "UPDATE tiles SET last_access = ? WHERE provider = ? AND z = ? AND x = ? AND y = ?",
+                    [(now, provider, *tile) for tile in found]
+                )
+        except sqlite3.OperationalError as e:
+            # Access times only steer eviction; never fail a render over them
+            logger.debug(f"Could not update tile access times: {e}")
+
+        return found
+
+    def put(self, provider, z, x, y, data):
+        """Store the bytes of a tile, evicting old tiles if the store grows too big."""
+        with self.transaction() as connection:
+            connection.execute(
+                """INSERT INTO tiles VALUES (?, ?, ?, ?, ?, ?, ?)
+                   ON CONFLICT (provider, z, x, y) DO UPDATE SET
+                       data = excluded.data, size = excluded.size, last_access = excluded.last_access""",
+                (provider, z, x, y, data, len(data), time.time())
+            )
+            total = connection.execute("SELECT bytes FROM totals").fetchone()[0]
+
+        if total > self.limit():
+            self.evict()
+
+    def put_absent(self, provider, z, x, y):
+        """Record that the provider has no such tile, so it is not requested again for a while."""
+        self.put(provider, z, x, y, b'')
+
+    def evict(self):
+        """Delete the least recently used tiles until the store is under its limit.
+
+        Returns the number of tiles deleted.
+        """
+        limit = self.limit()
+        target = int(limit * EVICTION_TARGET)
+        deleted = 0
+
+        with self.transaction() as connection:
+            total = connection.execute("SELECT bytes FROM totals").fetchone()[0]
+            if total <= limit:
+                return 0
+
+            # Walk tiles from least recently used, summing sizes until enough would be freed
+            cutoff = None
+            freed = 0
+            for last_access, size in connection.execute("SELECT last_access, size FROM tiles ORDER BY last_access"):
+                freed += size
+                cutoff = last_access
+                if total - freed <= target:
+                    break
+
+            if cutoff is not None:
+                deleted = connection.execute("DELETE FROM tiles WHERE last_access <= ?", (cutoff,)).rowcount
+
+        self.vacuum()
+        logger.info(f"Evicted {deleted} basemap tiles to stay under {limit / (1024 * 1024):.0f} MB")
+        return deleted
+
+    def clear(self, provider=None):
+        """Delete all stored tiles, or those of one provider.
+
+        provider matches a full provider identifier, or any provider whose
+        name starts with it followed by '.' or '-' (so 'Stadia' clears every
+        Stadia style). Returns the number of tiles deleted.
+        """
+        with self.transaction() as connection:
+            if provider is None:
+                deleted = connection.execute("DELETE FROM tiles").rowcount
+            else:
+                deleted = connection.execute(f"DELETE FROM tiles WHERE {PROVIDER_MATCH}", provider_patterns(provider)).rowcount
+
+        self.vacuum()
+        return deleted
+
+    def providers(self, provider=None):
+        """Get the stored providers, or those matching a name as clear() matches them."""
+        if provider is None:
+            rows = self.connection().execute("SELECT DISTINCT provider FROM tiles ORDER BY provider")
+        else:
+            rows = self.connection().execute(
+                f"SELECT DISTINCT provider FROM tiles WHERE {PROVIDER_MATCH} ORDER BY provider",
+                provider_patterns(provider)
+            )
+        return [row[0] for row in rows]
+
+    def tile_keys(self, provider, min_zoom=None, max_zoom=None):
+        """Get the (z, x, y) of every stored tile of a provider, optionally within a zoom range."""
+        rows = self.connection().execute(
+            "SELECT z, x, y FROM tiles WHERE provider = ? AND size > 0 AND z BETWEEN ? AND ? ORDER BY z, x, y",
+            (provider, 0 if min_zoom is None else min_zoom, 30 if max_zoom is None else max_zoom)
+        )
+        return [tuple(row) for row in rows]
+
+    def average_size(self, provider):
+        """Get the average size in bytes of a provider's stored tiles, or None if it has none."""
+        row = self.connection().execute("SELECT AVG(size) FROM tiles WHERE provider = ? AND size > 0", (provider,)).fetchone()
+        return row[0]
+
+    def iter_tiles(self, provider, keys):
+        """Yield (z, x, y, bytes) for the given stored tiles, in order, without marking them used."""
+        query = "SELECT data FROM tiles WHERE provider = ? AND z = ? AND x = ? AND y = ? AND size > 0"
+        for key in keys:
+            row = self.connection().execute(query, (provider, *key)).fetchone()
+            if row is not None:
+                yield (*key, row[0])
+
+    def vacuum(self):
+        """Give the space of deleted tiles back to the file system."""
+        # execute() would stop the pragma after its first freed page; a script runs it to completion
+        self.connection().executescript("PRAGMA incremental_vacuum;")
+
+    def info(self):
+        """Get store totals and a per-provider breakdown.
+
+        Returns a dict with 'tiles', 'bytes', 'max_bytes' and 'providers',
+        the latter mapping each provider to (tiles, bytes). Only the totals
+        are kept up to date as tiles change; the breakdown scans the whole
+        store, so this is meant for reports, not for rendering.
+        """
+        connection = self.connection()
+        tiles, total = connection.execute("SELECT tiles, bytes FROM totals").fetchone()
+        providers = {
+            provider: (count, size)
+            for provider, count, size in connection.execute(
+                "SELECT provider, COUNT(*), SUM(size) FROM tiles GROUP BY provider ORDER BY provider"
+            )
+        }
+        return {'tiles': tiles, 'bytes': total, 'max_bytes': self.limit(), 'providers': providers}
+
+def legacy_tiles_info():
+    """Get the number of files and bytes left in the old contextily tile cache."""
+    if not LEGACY_TILE_DIR.exists():
+        return 0, 0
+
+    files = [path for path in LEGACY_TILE_DIR.rglob('*') if path.is_file()]
+    return len(files), sum(path.stat().st_size for path in files)
+
+def clear_legacy_tiles():
+    """Delete the old contextily tile cache. Returns the number of files deleted."""
+    count, _ = legacy_tiles_info()
+    shutil.rmtree(LEGACY_TILE_DIR, ignore_errors=True)
+    return count
+
+class Transaction:
+    """Write transaction taking SQLite's write lock up front.
+
+    BEGIN IMMEDIATE makes a process wait for the lock at the start instead
+    of failing halfway when another process got there first.
+    """
+
+    def __init__(self, connection):
+        """Initialize with the connection to run the transaction on."""
+        self.connection = connection
+
+    def __enter__(self):
+        """Begin the transaction."""
+        self.connection.execute("BEGIN IMMEDIATE")
+        return self.connection
+
+    def __exit__(self, exc_type, exc, traceback):
+        """Commit, or roll back if the block raised."""
+        self.connection.execute("ROLLBACK" if exc_type else "COMMIT")
+        return False
+
+# Shared by every map generated in this process
+TILES = TileStore()
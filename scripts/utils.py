@@ -223,6 +223,20 @@ def ensure_directory(path):
     """Ensure directory exists."""
     Path(path).mkdir(parents=True, exist_ok=True)
 
+def binary_path(file_path):
+    """Get the path of the FlatGeobuf copy of a geodata file."""
+    return Path(file_path).with_suffix('.fgb')
+
+def save_geodata(gdf, output_path):
+    """Save a GeoDataFrame as GeoJSON plus a spatially indexed FlatGeobuf copy."""
+    output_path = Path(output_path)
+    gdf.to_file(output_path, driver='GeoJSON')
+
+    # FlatGeobuf has a packed R-tree, so map generation can read just the map area
+    gdf.to_file(binary_path(output_path), driver='FlatGeobuf', engine='pyogrio')
+
+    return output_path
+
 def get_file_size_mb(file_path):
     """Get file size in MB."""
     return Path(file_path).stat().st_size / (1024 * 1024)